@@ -1,179 +1,456 @@
 #!/usr/bin/env python
 import argparse
 import base64
+import collections
 import datetime
+import errno
 import json
 import logging
 import os
+import random
+import select
 import signal
+import socket
 import sys
+import threading
 import time
 import traceback
 import urlparse
 
 import config
-import lando
-import mozreview
 import psycopg2
 import treestatus
-from transplant import PatchTransplant, RepoTransplant
+from concurrent import futures
+from pingback import PingbackDispatcher
+from transplant import (
+    HG_CLIENTS,
+    PatchTransplant,
+    RepoTransplant,
+    TransplantTrain,
+    TransplantTrainError,
+    WORKING_COPIES,
+)
 
 
-# max attempts to transplant before bailing
-MAX_TRANSPLANT_ATTEMPTS = 50
+# max requests to land with a single push
+MAX_TRAIN_LENGTH = 10
 
-# max updates to post to reviewboard / iteration
-MOZREVIEW_COMMENT_LIMIT = 10
-
-# time to wait before attempting to update MozReview after a failure to post
-MOZREVIEW_RETRY_DELAY = datetime.timedelta(minutes=5)
+# default number of pending transplants to claim and process at a time
+TRANSPLANT_BATCH_SIZE = 50
 
 # time to wait before retrying a transplant
 TRANSPLANT_RETRY_DELAY = datetime.timedelta(minutes=5)
 
-logger = logging.getLogger("autoland")
+# time to wait before retrying a transplant which lost a push race; doubled
+# for every attempt up to TRANSPLANT_BACKOFF_MAX
+TRANSPLANT_BACKOFF_BASE = datetime.timedelta(seconds=5)
+TRANSPLANT_BACKOFF_MAX = datetime.timedelta(minutes=5)
 
+# max time to wait for a new request notification before checking for
+# pending transplants anyway
+TRANSPLANT_POLL_INTERVAL = datetime.timedelta(seconds=30)
 
-def handle_pending_transplants(dbconn):
-    cursor = dbconn.cursor()
-    now = datetime.datetime.now()
-    query = """
-        SELECT id, destination, request
-        FROM Transplant
-        WHERE landed IS NULL
-              AND (last_updated IS NULL OR last_updated<=%(time)s)
-        ORDER BY created
-    """
-    transplant_retry_delay = TRANSPLANT_RETRY_DELAY
-    if config.testing():
-        transplant_retry_delay = datetime.timedelta(seconds=1)
+# channel autoland_rest notifies when a new request is submitted
+TRANSPLANT_CHANNEL = "transplant"
 
-    cursor.execute(query, ({"time": now - transplant_retry_delay}))
+# channel notified when a transplant's result is recorded
+TRANSPLANT_STATUS_CHANNEL = "transplant_status"
 
-    current_treestatus = {}
-    finished_revisions = []
-    mozreview_updates = []
-    retry_revisions = []
+# how long a daemon's claim on a transplant lasts without a heartbeat
+TRANSPLANT_CLAIM_LEASE = datetime.timedelta(minutes=5)
 
-    def handle_tree_retry(reason, transplant_id, tree, rev, destination, trysyntax):
-        retry_revisions.append((now, transplant_id))
-        data = {
-            "request_id": transplant_id,
-            "tree": tree,
-            "rev": rev,
-            "destination": destination,
-            "trysyntax": trysyntax,
-            "landed": False,
-            "error_msg": "",
-            "result": reason,
-        }
-        mozreview_updates.append([transplant_id, json.dumps(data)])
+# time between heartbeats extending claims on in-progress transplants
+TRANSPLANT_HEARTBEAT = datetime.timedelta(minutes=1)
 
-    # This code is a bit messy because we have to deal with the fact that the
-    # the tree could close between the call to tree_is_open and when we
-    # actually attempt the revision.
-    #
-    # We keep a list of revisions to retry called retry_revisions which we
-    # append to whenever we detect a closed tree. These revisions have their
-    # last_updated field updated so we will retry them after a suitable delay.
-    #
-    # The other list we keep is for transplant attempts that either succeeded
-    # or failed due to a reason other than a closed tree, which is called
-    # finished_revisions. Successful or not, we're finished with them, they
-    # will not be retried.
-    for row in cursor.fetchall():
-        transplant_id, destination, request = row
+# advisory lock serialising claims between daemons
+CLAIM_LOCK_ID = 0x6175746F  # "auto"
+
+# identifies this daemon in Transplant.claimed_by
+WORKER_ID = "%s:%s" % (socket.gethostname(), os.getpid())
+
+logger = logging.getLogger("autoland")
+
+# cleared by the SIGTERM handler; workers finish their current transplant
+# then stop
+running = True
+
+
+class LandingRequest(object):
+    """A pending request read from the Transplant table.
+
+    The request is read without its inline patch, which can be large; the
+    patch is only fetched when the request is transplanted.
+    """
+
+    def __init__(self, row, fetch_inline_patch):
+        self.transplant_id, destination, self.request, self.attempts = row[:4]
+        self.has_inline_patch = row[4]
+        self.fetch_inline_patch = fetch_inline_patch
+        request = self.request
 
         # Many of these values are used as command arguments. So convert
         # to binary because command arguments aren't unicode.
-        destination = destination.encode("ascii")
-        requester = request["ldap_username"]
-        tree = request["tree"].encode("ascii")
-        rev = request["rev"].encode("ascii")
-        trysyntax = request.get("trysyntax", "")
-        push_bookmark = request.get("push_bookmark", "").encode("ascii")
-        commit_descriptions = request.get("commit_descriptions")
-        patch_urls = [u.encode("ascii") for u in request.get("patch_urls", [])]
-
-        repo_config = config.get_repo(tree)
-
-        if trysyntax:
+        self.destination = destination.encode("ascii")
+        self.requester = request["ldap_username"]
+        self.tree = request["tree"].encode("ascii")
+        self.rev = request["rev"].encode("ascii")
+        self.trysyntax = request.get("trysyntax", "")
+        self.push_bookmark = request.get("push_bookmark", "").encode("ascii")
+        self.commit_descriptions = request.get("commit_descriptions")
+        self.patch_urls = [u.encode("ascii") for u in request.get("patch_urls", [])]
+
+    def tree_name(self):
+        """Returns the name of the tree on treestatus, or None."""
+        if self.trysyntax:
             # When pushing to try we need to check if try is open, not the
             # tree for the source repo.
-            tree_name = "try"
-        else:
-            tree_name = repo_config.get("tree")
+            return "try"
+        return config.get_repo(self.tree).get("tree")
 
-        if not tree_name:
-            # Trees not present on treestatus cannot be closed.
-            tree_open = True
-        else:
-            tree_open = current_treestatus.setdefault(
-                destination, treestatus.tree_is_open(tree_name)
+    def is_inline_patch(self):
+        return config.testing() and self.has_inline_patch
+
+    def train_key(self):
+        """Returns the key of trains this request can join, or None.
+
+        Only patch based landings can be part of a train. The push is made
+        on behalf of a single user, so trains are per requester.
+        """
+        if self.trysyntax or not (self.patch_urls or self.is_inline_patch()):
+            return None
+        return (self.tree, self.destination, self.push_bookmark, self.requester)
+
+    def transplant(self):
+        if self.is_inline_patch():
+            return PatchTransplant(
+                self.tree,
+                self.destination,
+                self.rev,
+                None,
+                base64.b64decode(self.fetch_inline_patch(self.transplant_id)),
+                requester=self.requester,
             )
 
-        if not tree_open:
-            handle_tree_retry(
-                "Tree %s is closed - retrying later." % tree,
-                transplant_id,
-                tree,
-                rev,
-                destination,
-                trysyntax,
+        elif self.patch_urls:
+            return PatchTransplant(
+                self.tree,
+                self.destination,
+                self.rev,
+                self.patch_urls,
+                requester=self.requester,
             )
-            continue
 
-        attempts = 0
-        started = datetime.datetime.now()
-        landed = False
-        while attempts < MAX_TRANSPLANT_ATTEMPTS:
-            logger.info(
-                "initiating transplant from tree: %s rev: %s "
-                "to destination: %s, attempt %s"
-                % (tree, rev, destination, attempts + 1)
+        else:
+            return RepoTransplant(
+                self.tree,
+                self.destination,
+                self.rev,
+                self.commit_descriptions,
+                requester=self.requester,
             )
 
-            os.environ["AUTOLAND_REQUEST_USER"] = requester
-            try:
-                if config.testing() and request.get("patch"):
-                    tp = PatchTransplant(
-                        tree,
-                        destination,
-                        rev,
-                        None,
-                        base64.b64decode(request.get("patch")),
-                    )
 
-                elif patch_urls:
-                    tp = PatchTransplant(tree, destination, rev, patch_urls)
+def landing_trains(requests):
+    """Splits requests into trains of consecutive requests to land together."""
+    trains = []
+    for req in requests:
+        key = req.train_key()
+        if (
+            key is not None
+            and trains
+            and trains[-1][0].train_key() == key
+            and len(trains[-1]) < MAX_TRAIN_LENGTH
+        ):
+            trains[-1].append(req)
+        else:
+            trains.append([req])
+    return trains
 
-                else:
-                    tp = RepoTransplant(tree, destination, rev, commit_descriptions)
-
-                with tp:
-                    if trysyntax:
-                        result = tp.push_try(str(trysyntax))
-                    elif push_bookmark:
-                        result = tp.push_bookmark(push_bookmark)
-                    else:
-                        result = tp.push()
-                landed = True
-            except Exception as e:
-                logger.exception(e)
-                result = str(e)
-                landed = False
-            finally:
-                del os.environ["AUTOLAND_REQUEST_USER"]
 
-            logger.info(
-                "transplant from tree: %s rev: %s attempt: %s: %s"
-                % (tree, rev, attempts + 1, result)
+def get_transplant_retry_delay():
+    if config.testing():
+        return datetime.timedelta(seconds=1)
+    return TRANSPLANT_RETRY_DELAY
+
+
+def lost_push_race(result):
+    return (
+        "abort: push creates new remote head" in result
+        or "repository changed while pushing" in result
+    )
+
+
+def tree_closed(result):
+    return "is CLOSED!" in result or "APPROVAL REQUIRED" in result
+
+
+def get_push_race_backoff(attempts):
+    """Returns how long to wait before retrying after losing a push race."""
+    delay = min(
+        TRANSPLANT_BACKOFF_BASE.total_seconds() * 2 ** min(attempts, 16),
+        TRANSPLANT_BACKOFF_MAX.total_seconds(),
+    )
+    # Jitter the delay so requests which lost the same race don't all retry
+    # at the same time.
+    return datetime.timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+# Used by claim_pending_transplants; test-transplant-indexes.t checks its plan.
+CLAIM_PENDING_QUERY = """
+    WITH claimed AS (
+        UPDATE Transplant
+        SET claimed_by=%(worker)s,
+            claim_expires=statement_timestamp() + %(lease)s,
+            heartbeat=statement_timestamp()
+        WHERE id IN (
+            SELECT id
+            FROM Transplant t
+            WHERE landed IS NULL
+                  AND parked_tree IS NULL
+                  AND (next_attempt_at IS NULL OR next_attempt_at<=%(time)s)
+                  AND (claimed_by IS NULL
+                       OR claimed_by=%(worker)s
+                       OR claim_expires<statement_timestamp())
+                  AND NOT EXISTS (
+                      SELECT 1
+                      FROM Transplant c
+                      WHERE c.destination=t.destination
+                            AND c.landed IS NULL
+                            AND c.claimed_by<>%(worker)s
+                            AND c.claim_expires>=statement_timestamp()
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1
+                      FROM Transplant o
+                      WHERE o.destination=t.destination
+                            AND o.landed IS NULL
+                            AND o.parked_tree IS NULL
+                            AND o.next_attempt_at>%(time)s
+                            AND (o.created, o.id) < (t.created, t.id)
+                  )
+            ORDER BY created
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, destination, request - 'patch' AS request, attempts,
+                  request ? 'patch' AS has_inline_patch, created
+    )
+    SELECT id, destination, request, attempts, has_inline_patch
+    FROM claimed
+    ORDER BY created
+"""
+
+
+def claim_pending_transplants(dbconn, now, limit):
+    """Claims up to limit pending transplants, returning the claimed rows.
+
+    Requests are claimed with SKIP LOCKED so multiple daemons can share the
+    queue.  A destination is only claimed by one daemon at a time, to keep
+    landings to it in the order they were requested.  Claims which are not
+    kept alive by a heartbeat expire, allowing requests claimed by a daemon
+    which has died to be picked up by another.  Requests aren't claimed while
+    an earlier request to the same destination is backing off, so they don't
+    land ahead of it.
+
+    Only the columns needed to schedule the transplants are returned; inline
+    patches are left in the database until they're needed.
+    """
+    cursor = dbconn.cursor()
+
+    # Serialise claims between daemons, otherwise two daemons could both see
+    # a destination as unclaimed and claim different requests for it.
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (CLAIM_LOCK_ID,))
+
+    cursor.execute(
+        CLAIM_PENDING_QUERY,
+        {
+            "worker": WORKER_ID,
+            "lease": TRANSPLANT_CLAIM_LEASE,
+            "time": now,
+            "limit": limit,
+        },
+    )
+    rows = cursor.fetchall()
+    dbconn.commit()
+    return rows
+
+
+def heartbeat_transplants(dbconn):
+    """Extends the lease on the transplants claimed by this daemon."""
+    cursor = dbconn.cursor()
+    query = """
+        UPDATE Transplant
+        SET claim_expires=statement_timestamp() + %(lease)s,
+            heartbeat=statement_timestamp()
+        WHERE claimed_by=%(worker)s
+              AND landed IS NULL
+    """
+    cursor.execute(query, {"worker": WORKER_ID, "lease": TRANSPLANT_CLAIM_LEASE})
+    dbconn.commit()
+
+
+def release_transplants(dbconn):
+    """Releases unfinished transplants claimed by this daemon."""
+    cursor = dbconn.cursor()
+    query = """
+        UPDATE Transplant
+        SET claimed_by=NULL,
+            claim_expires=NULL
+        WHERE claimed_by=%(worker)s
+              AND landed IS NULL
+    """
+    cursor.execute(query, {"worker": WORKER_ID})
+    dbconn.commit()
+
+
+def handle_pending_transplants(dbconn, workers=1, batch_size=TRANSPLANT_BATCH_SIZE):
+    """Claims and processes a batch of pending transplants.
+
+    Returns the number of transplants claimed; if this is batch_size there
+    may be more pending.
+    """
+    cursor = dbconn.cursor()
+    now = datetime.datetime.now()
+    rows = claim_pending_transplants(dbconn, now, batch_size)
+    if not rows:
+        return 0
+
+    destination_stats = {}
+
+    # The connection is shared with the worker threads; each holds the lock
+    # for the duration of its transaction.
+    db_lock = threading.Lock()
+
+    def fetch_inline_patch(transplant_id):
+        with db_lock:
+            cursor.execute(
+                "SELECT request->>'patch' FROM Transplant WHERE id=%s",
+                (transplant_id,),
             )
+            patch = cursor.fetchone()[0]
+            dbconn.commit()
+        return patch
+
+    def record_transplant(req, query, params, data=None, finished=False):
+        # Each result is committed along with its pingback as soon as it's
+        # known, so a landing is reported straight away and isn't lost (and
+        # pushed again) if the daemon dies before the rest of the batch is
+        # done.
+        with db_lock:
+            try:
+                cursor.execute(query, params)
+                if data:
+                    # The pingback url is stored with the update so the
+                    # pingback dispatcher doesn't have to look it up.
+                    # Intermediate updates replace any undelivered
+                    # intermediate update for the transplant, so a long tree
+                    # closure doesn't pile up retry notices; final results
+                    # are always delivered.
+                    pingback_url = req.request.get("pingback_url")
+                    cursor.execute(
+                        """
+                        insert into MozreviewUpdate(transplant_id,data,
+                                                    pingback_url,host,final)
+                        values(%s,%s,%s,%s,%s)
+                        on conflict (transplant_id) where not final
+                        do update set data=excluded.data
+                        """,
+                        (
+                            req.transplant_id,
+                            json.dumps(data),
+                            pingback_url,
+                            urlparse.urlparse(pingback_url or "").hostname,
+                            finished,
+                        ),
+                    )
+                if finished:
+                    # Wake up API requests waiting for the result.
+                    cursor.execute(
+                        "SELECT pg_notify(%s, %s)",
+                        (TRANSPLANT_STATUS_CHANNEL, str(req.transplant_id)),
+                    )
+                dbconn.commit()
+            except Exception:
+                dbconn.rollback()
+                raise
 
-            if landed or "abort: push creates new remote head" not in result:
-                break
+    def record_retry(req, retry_at, data=None):
+        # Release the claim so any daemon can pick up the retry.
+        query = """
+            update Transplant set last_updated=%s,next_attempt_at=%s,attempts=%s,
+                                  claimed_by=NULL,claim_expires=NULL
+            where id=%s
+        """
+        params = (datetime.datetime.now(), retry_at, req.attempts, req.transplant_id)
+        record_transplant(req, query, params, data)
+
+    def release_claims(reqs):
+        # Hand the requests back so they're claimed again once the request
+        # ahead of them is due.
+        if not reqs:
+            return
+        with db_lock:
+            try:
+                cursor.execute(
+                    """
+                    update Transplant set claimed_by=NULL,claim_expires=NULL
+                    where id=any(%s) and claimed_by=%s
+                    """,
+                    ([req.transplant_id for req in reqs], WORKER_ID),
+                )
+                dbconn.commit()
+            except Exception:
+                dbconn.rollback()
+                raise
+
+    def record_finished(req, landed, result, data):
+        query = """
+            update Transplant set landed=%s,result=%s,attempts=%s
+            where id=%s
+        """
+        params = (landed, result, req.attempts, req.transplant_id)
+        record_transplant(req, query, params, data, finished=True)
+
+    def record_push_attempt(destination, race_lost):
+        stats = destination_stats.setdefault(
+            destination, {"attempts": 0, "race_losses": 0, "last_race_loss": None}
+        )
+        stats["attempts"] += 1
+        if race_lost:
+            stats["race_losses"] += 1
+            stats["last_race_loss"] = datetime.datetime.now()
+
+    def record_parked(req, tree_name, data):
+        # Parked requests aren't claimed again until the tree reopens, see
+        # unpark_transplants.
+        query = """
+            update Transplant set last_updated=%s,next_attempt_at=NULL,
+                                  attempts=%s,parked_tree=%s,
+                                  claimed_by=NULL,claim_expires=NULL
+            where id=%s
+        """
+        params = (datetime.datetime.now(), req.attempts, tree_name, req.transplant_id)
+        record_transplant(req, query, params, data)
+
+    def handle_tree_retry(reason, req):
+        data = {
+            "request_id": req.transplant_id,
+            "tree": req.tree,
+            "rev": req.rev,
+            "destination": req.destination,
+            "trysyntax": req.trysyntax,
+            "landed": False,
+            "error_msg": "",
+            "result": reason,
+        }
+        tree_name = req.tree_name()
+        if tree_name:
+            record_parked(req, tree_name, data)
+        else:
+            record_retry(req, now + get_transplant_retry_delay(), data)
 
-            attempts += 1
+    def handle_result(req, landed, result, started, backoff=None):
+        tree, rev, destination = req.tree, req.rev, req.destination
 
         if landed:
             logger.info("transplant successful - new revision: %s" % result)
@@ -182,31 +459,30 @@ def handle_pending_transplants(dbconn):
             if "is CLOSED!" in result:
                 reason = "Tree %s is closed - retrying later." % tree
                 logger.info("transplant failed: %s" % reason)
-                current_treestatus[destination] = False
-                handle_tree_retry(
-                    reason, transplant_id, tree, rev, destination, trysyntax
-                )
-                continue
+                if req.tree_name():
+                    treestatus.set_closed(req.tree_name())
+                handle_tree_retry(reason, req)
+                return
 
             elif "APPROVAL REQUIRED" in result:
                 reason = (
                     'Tree %s is set to "approval required" - retrying ' "later." % tree
                 )
                 logger.info("transplant failed: %s" % reason)
-                current_treestatus[destination] = False
-                handle_tree_retry(
-                    reason, transplant_id, tree, rev, destination, trysyntax
-                )
-                continue
+                if req.tree_name():
+                    treestatus.set_closed(req.tree_name())
+                handle_tree_retry(reason, req)
+                return
 
-            elif (
-                "abort: push creates new remote head" in result
-                or "repository changed while pushing" in result
-            ):
-                logger.info("transplant failed: we lost a push race")
+            elif lost_push_race(result):
+                backoff = backoff or get_push_race_backoff(req.attempts)
+                logger.info(
+                    "transplant failed: we lost a push race, "
+                    "retrying in %s" % backoff
+                )
                 logger.info(result)
-                retry_revisions.append((now, transplant_id))
-                continue
+                record_retry(req, datetime.datetime.now() + backoff)
+                return
 
             elif (
                 "unresolved conflicts (see hg resolve" in result
@@ -239,11 +515,11 @@ def handle_pending_transplants(dbconn):
 
         # set up data to be posted back to mozreview
         data = {
-            "request_id": transplant_id,
+            "request_id": req.transplant_id,
             "tree": tree,
             "rev": rev,
             "destination": destination,
-            "trysyntax": trysyntax,
+            "trysyntax": req.trysyntax,
             "landed": landed,
             "error_msg": "",
             "result": "",
@@ -254,120 +530,291 @@ def handle_pending_transplants(dbconn):
         else:
             data["error_msg"] = result
 
-        mozreview_updates.append([transplant_id, json.dumps(data)])
-
-        finished_revisions.append([landed, result, transplant_id])
-
-    if retry_revisions:
-        query = """
-            update Transplant set last_updated=%s
-            where id=%s
-        """
-        cursor.executemany(query, retry_revisions)
-        dbconn.commit()
-
-    if finished_revisions:
-        query = """
-            update Transplant set landed=%s,result=%s
-            where id=%s
-        """
-        cursor.executemany(query, finished_revisions)
-        dbconn.commit()
-
-    if mozreview_updates:
-        query = """
-            insert into MozreviewUpdate(transplant_id,data)
-            values(%s,%s)
-        """
-        cursor.executemany(query, mozreview_updates)
-        dbconn.commit()
+        record_finished(req, landed, result, data)
 
+    # This code is a bit messy because we have to deal with the fact that the
+    # the tree could close between the call to tree_is_open and when we
+    # actually attempt the revision.
+    #
+    # Whenever we detect a closed tree or lose a push race the request has its
+    # next_attempt_at field updated so we will retry it after a suitable
+    # delay.
+    #
+    # Requests that either succeeded or failed due to a reason other than a
+    # closed tree are finished. Successful or not, we're finished with them,
+    # they will not be retried.
+    #
+    # Requests are transplanted as a train: a list of one or more requests
+    # which are applied in order on the same working copy then pushed
+    # together.
+    #
+    # Returns True if the train has to back off after losing a push race; the
+    # requests behind it for the same destination must wait for it, to keep
+    # landings in order.
+    def transplant_train(train):
+        lead = train[0]
+        tree, destination = lead.tree, lead.destination
+        tree_name = lead.tree_name()
 
-def handle_pending_mozreview_updates(dbconn):
-    """Attempt to post updates to mozreview"""
+        if not tree_name:
+            # Trees not present on treestatus cannot be closed.
+            tree_open = True
+        else:
+            tree_open = treestatus.tree_is_open(tree_name)
 
-    cursor = dbconn.cursor()
-    query = """
-        select MozreviewUpdate.id,transplant_id,request,data
-        from MozreviewUpdate inner join Transplant
-        on (Transplant.id = MozreviewUpdate.transplant_id)
-        limit %(limit)s
-    """
-    cursor.execute(query, {"limit": MOZREVIEW_COMMENT_LIMIT})
+        if not tree_open:
+            for req in train:
+                handle_tree_retry("Tree %s is closed - retrying later." % tree, req)
+            return False
+
+        while train:
+            revs = ", ".join(req.rev for req in train)
+            started = datetime.datetime.now()
+            landed = False
+            failed_req = None
+            logger.info(
+                "initiating transplant from tree: %s rev: %s "
+                "to destination: %s, attempt %s"
+                % (tree, revs, destination, lead.attempts + 1)
+            )
 
-    mozreview_pingback = mozreview.MozReviewPingback()
-    lando_pingback = lando.LandoPingback()
+            try:
+                transplants = [req.transplant() for req in train]
+                if len(transplants) == 1:
+                    tp = transplants[0]
+                    with tp:
+                        if lead.trysyntax:
+                            result = tp.push_try(str(lead.trysyntax))
+                        elif lead.push_bookmark:
+                            result = tp.push_bookmark(lead.push_bookmark)
+                        else:
+                            result = tp.push()
+                    results = [result]
+                else:
+                    with TransplantTrain(transplants) as tp:
+                        results = tp.push(lead.push_bookmark)
+                    result = ", ".join(results)
+                landed = True
+            except TransplantTrainError as e:
+                logger.exception(e)
+                result = str(e)
+                failed_req = train[transplants.index(e.transplant)]
+            except Exception as e:
+                logger.exception(e)
+                result = str(e)
 
-    completed = []
-    failed = False
-    for row in cursor.fetchall():
-        update_id, transplant_id, request, data = row
+            logger.info(
+                "transplant from tree: %s rev: %s attempt: %s: %s"
+                % (tree, revs, lead.attempts + 1, result)
+            )
 
-        # Validate the pingback hostname is still present in config.json.
-        pingback_url = request.get("pingback_url")
-        hostname = urlparse.urlparse(pingback_url).hostname
+            if (
+                not landed
+                and not failed_req
+                and len(train) > 1
+                and not lost_push_race(result)
+                and not tree_closed(result)
+            ):
+                # The push was rejected, for example by a hook, and we can't
+                # tell which request caused it. Land the requests one at a
+                # time so only the one at fault fails.
+                logger.info("landing revs: %s one at a time" % revs)
+                for index, req in enumerate(train):
+                    if transplant_train([req]):
+                        release_claims(train[index + 1 :])
+                        return True
+                return False
+
+            for req in train:
+                req.attempts += 1
+            record_push_attempt(destination, not landed and lost_push_race(result))
+
+            if failed_req:
+                # One request in the train couldn't be applied. Report its
+                # failure and try again with the rest of the train.
+                logger.info("splitting rev: %s out of landing train" % failed_req.rev)
+                handle_result(failed_req, False, result, started)
+                train = [req for req in train if req is not failed_req]
+                continue
 
-        if hostname == "localhost":
-            # localhost pingbacks are always a NO-OP; used during development
-            # and testing.
-            pingback_url = None
+            if landed:
+                for req, rev in zip(train, results):
+                    handle_result(req, True, rev, started)
+            else:
+                # Retry the whole train at the same time if it has to back off.
+                backoff = get_push_race_backoff(lead.attempts)
+                for req in train:
+                    handle_result(req, False, result, started, backoff)
+            return not landed and lost_push_race(result)
+
+    # Each destination gets its own queue, preserving the request order
+    # within it. Queues are independent of each other so they can be worked
+    # on in parallel, each leasing a working copy from WORKING_COPIES; a slow
+    # rebase onto one tree no longer holds up landings to unrelated trees.
+    landing_requests = [LandingRequest(row, fetch_inline_patch) for row in rows]
+    queues = collections.OrderedDict()
+    for req in landing_requests:
+        queues.setdefault(req.destination, []).append(req)
+
+    # Fetch the status of all the trees we need in one go.
+    treestatus.refresh(set(filter(None, (r.tree_name() for r in landing_requests))))
+
+    def process_queue(queue):
+        trains = landing_trains(queue)
+        for index, train in enumerate(trains):
+            # Stop picking up new requests once we've been asked to shut
+            # down; unprocessed requests will be picked up on restart.
+            if not running:
+                break
+            if transplant_train(train):
+                # Landing the rest of the queue now would push it ahead of
+                # the train which is backing off.
+                release_claims([req for t in trains[index + 1 :] for req in t])
+                break
 
-        else:
-            if hostname not in config.get("pingback", {}):
-                logger.error("ignoring pingback to %s: unconfigured" % hostname)
-                pingback_url = None
+    # Transplants always run on worker threads, even with a single worker, so
+    # the main thread is free to keep our claims alive.
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    failed = []
+    try:
+        pending = set(
+            executor.submit(process_queue, queue) for queue in queues.values()
+        )
+        last_heartbeat = datetime.datetime.now()
+        # Wait with a timeout so the main thread is able to handle
+        # SIGTERM while the workers finish their current transplant. Keep
+        # heartbeating until every worker has finished, even if one of them
+        # has failed, otherwise another daemon could claim and push the
+        # transplants still in progress.
+        while pending:
+            done, pending = futures.wait(pending, timeout=1)
+            failed.extend(future for future in done if future.exception())
+
+            if datetime.datetime.now() - last_heartbeat > TRANSPLANT_HEARTBEAT:
+                with db_lock:
+                    try:
+                        heartbeat_transplants(dbconn)
+                    except Exception as e:
+                        logger.exception(e)
+                        if not dbconn.closed:
+                            dbconn.rollback()
+                last_heartbeat = datetime.datetime.now()
+    finally:
+        executor.shutdown(wait=True)
+
+    if failed:
+        for future in failed[1:]:
+            logger.error("transplant worker failed: %s" % future.exception())
+        failed[0].result()
+
+    if destination_stats:
+        query = """
+            insert into DestinationStats(destination,attempts,race_losses,
+                                         last_race_loss)
+            values(%(destination)s,%(attempts)s,%(race_losses)s,
+                   %(last_race_loss)s)
+            on conflict (destination) do update
+            set attempts=DestinationStats.attempts+excluded.attempts,
+                race_losses=DestinationStats.race_losses+excluded.race_losses,
+                last_race_loss=coalesce(excluded.last_race_loss,
+                                        DestinationStats.last_race_loss)
+        """
+        cursor.executemany(
+            query,
+            [
+                dict(stats, destination=destination)
+                for destination, stats in destination_stats.items()
+            ],
+        )
+        dbconn.commit()
 
-        # Use the appropriate handler for this pingback.
-        if pingback_url:
-            pingback_config = config.get("pingback").get(hostname)
+    return len(rows)
 
-            if pingback_config["type"] == "mozreview":
-                pingback = mozreview_pingback
 
-            elif pingback_config["type"] == "lando":
-                pingback = lando_pingback
+def unpark_transplants(dbconn):
+    """Re-queues the requests parked for closed trees which have reopened.
 
-            else:
-                logger.warning("ignoring pinback to %s: not supported" % hostname)
-                pingback_url = None
+    Returns when the status of the trees which are still closed should next
+    be checked, or None if no requests are parked.
+    """
+    cursor = dbconn.cursor()
+    cursor.execute(
+        """
+        SELECT DISTINCT parked_tree
+        FROM Transplant
+        WHERE landed IS NULL
+              AND parked_tree IS NOT NULL
+    """
+    )
+    trees = [row[0] for row in cursor.fetchall()]
+    dbconn.commit()
+    if not trees:
+        return None
+
+    # Tree status is cached, so this only goes to treestatus once a tree's
+    # cached status has expired.
+    treestatus.refresh(trees)
+    reopened = [tree for tree in trees if treestatus.tree_is_open(tree)]
+    if reopened:
+        cursor.execute(
+            """
+            UPDATE Transplant
+            SET parked_tree=NULL
+            WHERE landed IS NULL
+                  AND parked_tree=ANY(%s)
+        """,
+            (reopened,),
+        )
+        logger.info(
+            "trees reopened: %s, requeued %s transplants"
+            % (", ".join(reopened), cursor.rowcount)
+        )
+        # Wake up the other daemons.
+        cursor.execute("SELECT pg_notify(%s, '')", (TRANSPLANT_CHANNEL,))
+        dbconn.commit()
 
-        # Update the requester if required.
-        if pingback_url:
-            logger.info(
-                "trying to post %s update to: %s for request: %s"
-                % (pingback.name, pingback_url, transplant_id)
-            )
+    closed = [tree for tree in trees if tree not in reopened]
+    if not closed:
+        return None
+    return min(treestatus.next_check(tree) for tree in closed)
 
-            status_code, text = pingback.update(pingback_url, data)
 
-            if status_code == 200:
-                # Success.
-                completed.append([update_id])
+def next_transplant_retry(dbconn):
+    """Returns when the next delayed transplant is due, or None."""
+    cursor = dbconn.cursor()
+    query = """
+        SELECT min(next_attempt_at)
+        FROM Transplant
+        WHERE landed IS NULL
+              AND next_attempt_at>%(now)s
+    """
+    cursor.execute(query, {"now": datetime.datetime.now()})
+    next_retry = cursor.fetchone()[0]
+    # Don't sit idle in a transaction while waiting, it would block schema
+    # changes.
+    dbconn.commit()
+    return next_retry
 
-            elif status_code == 404:
-                # Submitting system "forgot" about this request; delete it
-                # so we can continuing processing pending updates.
-                logger.info("failed: %s - %s" % (status_code, text))
-                completed.append([update_id])
 
-            else:
-                # Treat anything else as a transient failure.
-                logger.info("failed: %s - %s" % (status_code, text))
-                failed = True
-                break
+def wait_for_transplants(listen_dbconn, deadline):
+    """Blocks until a new request is submitted or the deadline passes."""
+    timeout = (deadline - datetime.datetime.now()).total_seconds()
 
-        else:
-            completed.append([update_id])
+    # Never spin faster than the old polling loop did.
+    timeout = max(timeout, 0.1)
 
-    if completed:
-        query = """
-            delete from MozreviewUpdate
-            where id=%s
-        """
-        cursor.executemany(query, completed)
-        dbconn.commit()
+    try:
+        select.select([listen_dbconn], [], [], timeout)
+    except select.error as e:
+        # Interrupted by a signal; let the main loop check if it's still
+        # running.
+        if e.args[0] != errno.EINTR:
+            raise
 
-    return not failed
+    # Discard the notifications, handle_pending_transplants will pick up all
+    # pending requests regardless of which notification woke us.
+    listen_dbconn.poll()
+    del listen_dbconn.notifies[:]
 
 
 def get_dbconn(dsn):
@@ -380,12 +827,35 @@ def get_dbconn(dsn):
     return dbconn
 
 
+def get_listen_dbconn(dsn):
+    # Notifications are only delivered outside of a transaction, so the
+    # listening connection has to be separate from the one used to process
+    # requests.
+    dbconn = get_dbconn(dsn)
+    dbconn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = dbconn.cursor()
+    cursor.execute("LISTEN %s" % TRANSPLANT_CHANNEL)
+    return dbconn
+
+
 def main():
     parser = argparse.ArgumentParser()
 
     dsn = config.get("database")
 
     parser.add_argument("--dsn", default=dsn, help="Postgresql DSN connection string")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.get("transplant_workers", 1),
+        help="Number of working copies to transplant into concurrently",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=config.get("transplant_batch_size", TRANSPLANT_BATCH_SIZE),
+        help="Number of pending transplants to claim at a time",
+    )
     args = parser.parse_args()
 
     # log to stdout
@@ -399,6 +869,7 @@ def main():
 
     logger.info("starting autoland")
     dbconn = get_dbconn(args.dsn)
+    listen_dbconn = get_listen_dbconn(args.dsn)
 
     # Set up signal handling to ensure we aren't cancelled mid-transplant.
     global running
@@ -412,26 +883,35 @@ def main():
     signal.signal(signal.SIGTERM, handle_term)
     signal.signal(signal.SIGINT, handle_term)
 
+    # Updates are posted to the requesting systems from their own threads, so
+    # a long transplant doesn't hold them up.
+    dispatcher = PingbackDispatcher(lambda: get_dbconn(args.dsn))
+    dispatcher.start()
+
     last_error_msg = None
-    next_mozreview_update = datetime.datetime.now()
     while running:
         try:
-            handle_pending_transplants(dbconn)
-
-            # TODO: In normal configuration, all updates will be posted to the
-            # same MozReview instance, so we don't bother tracking failure to
-            # post for individual urls. In the future, we might need to
-            # support this.
-            if datetime.datetime.now() > next_mozreview_update:
-                ok = handle_pending_mozreview_updates(dbconn)
-                if ok:
-                    next_mozreview_update += datetime.timedelta(seconds=1)
-                else:
-                    next_mozreview_update += MOZREVIEW_RETRY_DELAY
+            next_unpark = unpark_transplants(dbconn)
+            claimed = handle_pending_transplants(
+                dbconn, workers=args.workers, batch_size=args.batch_size
+            )
 
-            time.sleep(0.1)
+            # A full batch means there's probably more work waiting.
+            if claimed >= args.batch_size:
+                continue
+
+            # Sleep until a request is submitted, a delayed transplant is
+            # due to be retried, or a closed tree's status is to be checked.
+            deadlines = [datetime.datetime.now() + TRANSPLANT_POLL_INTERVAL]
+            next_retry = next_transplant_retry(dbconn)
+            if next_retry:
+                deadlines.append(next_retry)
+            if next_unpark:
+                deadlines.append(next_unpark)
+            wait_for_transplants(listen_dbconn, min(deadlines))
         except psycopg2.InterfaceError:
             dbconn = get_dbconn(args.dsn)
+            listen_dbconn = get_listen_dbconn(args.dsn)
         except:
             # If things go really badly, we might see the same exception
             # thousands of times in a row. There's not really any point in
@@ -441,6 +921,17 @@ def main():
                 logger.error(error_msg)
                 last_error_msg = error_msg
 
+    WORKING_COPIES.wait_for_resets()
+    HG_CLIENTS.close_all()
+    dispatcher.stop()
+
+    # Hand back anything we claimed but didn't get to, rather than making other
+    # daemons wait for the lease to expire.
+    try:
+        release_transplants(dbconn)
+    except psycopg2.Error as e:
+        logger.error("failed to release claimed transplants: %s" % e)
+
 
 if __name__ == "__main__":
     main()
@@ -1,18 +1,42 @@
 #!/usr/bin/env python
 import base64
+import contextlib
 import hmac
 import ipaddress
 import json
 import logging
+import math
+import select
 import socket
+import threading
+import time
 import urlparse
 
 import config
 import psycopg2
-from flask import Flask, Response, abort, jsonify, make_response, request
+import psycopg2.pool
+from flask import Flask, Response, abort, g, jsonify, make_response, request
 
 app = Flask(__name__, static_url_path="", static_folder="")
 
+# channel the autoland daemon listens on for new requests
+TRANSPLANT_CHANNEL = "transplant"
+
+# channel the autoland daemon notifies when it records a transplant's result
+STATUS_CHANNEL = "transplant_status"
+
+# max time a status request can wait for a request to finish, in seconds
+STATUS_MAX_WAIT = 60
+
+# max requests which can be submitted to /autoland/batch at once
+MAX_BATCH_SIZE = 100
+
+# default number of database connections per process
+DATABASE_POOL_SIZE = 4
+
+# pooled connections idle for longer than this are checked before use
+DATABASE_HEALTH_CHECK_AGE = 30
+
 
 @app.errorhandler(401)
 def auth_required(_):
@@ -31,8 +55,192 @@ def internal_server_error(error):
     return make_response(jsonify({"error": str(error)}), 500)
 
 
+class ConnectionPool(object):
+    """A thread safe pool of database connections.
+
+    psycopg2's ThreadedConnectionPool raises an error when all connections
+    are in use; this waits for one to be returned instead, and keeps track of
+    how long requests wait for a connection and how many are in use.
+    """
+
+    def __init__(self, dsn, size):
+        self.size = size
+        self._pool = psycopg2.pool.ThreadedConnectionPool(size, size, dsn)
+        self._available = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.in_use = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(conn))
+        if last_used and time.time() - last_used < DATABASE_HEALTH_CHECK_AGE:
+            return True
+        try:
+            conn.cursor().execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.time()
+        self._available.acquire()
+        waited = time.time() - start
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                # Replace connections the server has dropped.
+                self._discard(conn)
+                conn = self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def putconn(self, conn):
+        try:
+            try:
+                # Don't hand a connection with an open transaction to the
+                # next request.
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._last_used[id(conn)] = time.time()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._available.release()
+
+    def stats(self):
+        with self._lock:
+            mean_wait_time = self.wait_time / self.acquired if self.acquired else 0.0
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "utilisation": float(self.in_use) / self.size,
+                "acquired": self.acquired,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.max_wait_time,
+                "wait_time_mean": mean_wait_time,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                config.get("database"),
+                max(config.get("database_pool_size", DATABASE_POOL_SIZE), 1),
+            )
+    return _pool
+
+
 def get_dbconn():
-    return psycopg2.connect(config.get("database"))
+    """Returns a pooled connection, returned to the pool after the request."""
+    if "dbconn" not in g:
+        g.dbconn = get_pool().getconn()
+    return g.dbconn
+
+
+def release_dbconn():
+    """Returns the request's connection to the pool before the request ends."""
+    dbconn = g.pop("dbconn", None)
+    if dbconn is not None:
+        get_pool().putconn(dbconn)
+
+
+@app.teardown_appcontext
+def return_dbconn(_):
+    release_dbconn()
+
+
+class StatusListener(object):
+    """Wakes requests waiting for transplants to finish.
+
+    A single connection per process listens for the notifications the
+    daemon sends when it records a result, so waiting requests don't hold a
+    pooled connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._thread = None
+
+    @contextlib.contextmanager
+    def watch(self, request_ids):
+        """Yields an event which is set when one of the requests finishes."""
+        event = threading.Event()
+        with self._lock:
+            for request_id in request_ids:
+                self._waiters.setdefault(request_id, set()).add(event)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen)
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            yield event
+        finally:
+            with self._lock:
+                for request_id in request_ids:
+                    waiters = self._waiters[request_id]
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[request_id]
+
+    def _notify(self, request_id):
+        with self._lock:
+            for event in self._waiters.get(request_id, ()):
+                event.set()
+
+    def _listen(self):
+        while True:
+            dbconn = None
+            try:
+                dbconn = psycopg2.connect(config.get("database"))
+                dbconn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
+                )
+                dbconn.cursor().execute("LISTEN %s" % STATUS_CHANNEL)
+                while True:
+                    select.select([dbconn], [], [], 60)
+                    dbconn.poll()
+                    while dbconn.notifies:
+                        self._notify(int(dbconn.notifies.pop(0).payload))
+            except Exception as e:
+                # Waiting requests still return once their wait expires.
+                app.logger.error("status listener failed: %s" % e)
+                if dbconn is not None:
+                    dbconn.close()
+                time.sleep(1)
+
+
+STATUS_LISTENER = StatusListener()
 
 
 def compare_digest_backport(a, b):
@@ -54,6 +262,18 @@ def check_auth(user, passwd):
     return compare_digest(auth[user].encode("utf8"), passwd.encode("utf8"))
 
 
+def require_auth():
+    auth = request.authorization
+    if not auth:
+        abort(401)
+    if not check_auth(auth.username, auth.password):
+        logging.warn(
+            'Failed authentication for "%s" from %s'
+            % (auth.username, request.remote_addr)
+        )
+        abort(401)
+
+
 def check_pingback_url(pingback_url):
     try:
         url = urlparse.urlparse(pingback_url)
@@ -111,10 +331,9 @@ def check_patch_url(patch_url):
     return True
 
 
-def validate_request(req):
-    if req.json is None:
+def validate_request(request_json):
+    if not isinstance(request_json, dict):
         raise ValueError("missing json")
-    request_json = req.json
 
     required = {"ldap_username", "tree", "rev", "pingback_url", "destination"}
     optional = set()
@@ -167,6 +386,10 @@ def validate_request(req):
             % ("" if len(extra) == 1 else "s", ", ".join(sorted(extra)))
         )
 
+    for field in ("ldap_username", "tree", "rev", "destination", "pingback_url"):
+        if not isinstance(request_json[field], basestring):
+            raise ValueError("%s must be a string" % field)
+
     if not check_pingback_url(request_json["pingback_url"]):
         raise ValueError("bad pingback_url")
 
@@ -188,6 +411,13 @@ def validate_request(req):
                 raise ValueError("malformed base64 in patch")
 
 
+def in_progress_error(request_json):
+    return "Bad Request: a request to land revision %s to %s is already in progress" % (
+        request_json["rev"],
+        request_json["destination"],
+    )
+
+
 @app.route("/autoland", methods=["POST"])
 def autoland():
     """
@@ -253,54 +483,84 @@ def autoland():
     Returns an id which can be used to get the status of the autoland
     request.
 
+    Clients may provide an "Idempotency-Key" header; a request submitted
+    again with the same key returns the id of the original request.
+
     """
 
-    auth = request.authorization
-    if not auth:
-        abort(401)
-    if not check_auth(auth.username, auth.password):
-        logging.warn(
-            'Failed authentication for "%s" from %s'
-            % (auth.username, request.remote_addr)
-        )
-        abort(401)
+    require_auth()
 
     try:
-        validate_request(request)
+        validate_request(request.json)
     except ValueError as e:
         app.logger.warn("Bad Request from %s: %s" % (request.remote_addr, e))
         return make_response(jsonify({"error": "Bad request: %s" % e}), 400)
 
+    idempotency_key = request.headers.get("Idempotency-Key")
+
     try:
         dbconn = get_dbconn()
         cursor = dbconn.cursor()
 
+        # Duplicate submissions conflict with the unique indexes on in-flight
+        # requests and idempotency keys, in which case the existing request is
+        # returned instead.  A conflicting request committed after this
+        # statement started isn't visible to it, so that case is retried.
         query = """
-            SELECT created, request->>'ldap_username'
-              FROM Transplant
-             WHERE landed IS NULL
-                   AND request->>'rev' = %s
-                   AND request->>'destination' = %s
-        """
-        cursor.execute(query, (request.json["rev"], request.json["destination"]))
-        in_flight = cursor.fetchone()
-        if in_flight:
-            error = (
-                "Bad Request: a request to land revision %s to %s is already "
-                "in progress" % (request.json["rev"], request.json["destination"])
+            WITH inserted AS (
+                INSERT INTO Transplant (destination, request, idempotency_key)
+                VALUES (%(destination)s, %(request)s, %(idempotency_key)s)
+                ON CONFLICT DO NOTHING
+                RETURNING id
             )
-            app.logger.warn("%s from %s at %s" % (error, in_flight[0], in_flight[1]))
+            SELECT id, TRUE, NULL, NULL, NULL
+              FROM inserted
+             UNION ALL
+            SELECT * FROM (
+                SELECT id, FALSE, created, request->>'ldap_username',
+                       idempotency_key
+                  FROM Transplant
+                 WHERE NOT EXISTS (SELECT 1 FROM inserted)
+                       AND (idempotency_key = %(idempotency_key)s
+                            OR (landed IS NULL
+                                AND request->>'rev' = %(rev)s
+                                AND destination = %(destination)s))
+                 ORDER BY (idempotency_key = %(idempotency_key)s) IS TRUE DESC
+                 LIMIT 1
+            ) existing
+        """
+        params = {
+            "destination": request.json["destination"],
+            "rev": request.json["rev"],
+            "request": json.dumps(request.json),
+            "idempotency_key": idempotency_key,
+        }
+        row = None
+        for _ in range(3):
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+            if row:
+                break
+        if not row:
+            raise Exception("failed to insert or find conflicting request")
+        request_id, inserted, created, requester, existing_key = row
+
+        if not inserted:
+            if idempotency_key is not None and existing_key == idempotency_key:
+                app.logger.info(
+                    "request with idempotency key %s already received as %s"
+                    % (idempotency_key, request_id)
+                )
+                return jsonify({"request_id": request_id})
+
+            error = in_progress_error(request.json)
+            app.logger.warn("%s from %s at %s" % (error, created, requester))
             return make_response(jsonify({"error": error}), 400)
 
         app.logger.info("received transplant request: %s" % json.dumps(request.json))
 
-        query = """
-            insert into Transplant(destination, request)
-            values (%s, %s)
-            returning id
-        """
-        cursor.execute(query, (request.json["destination"], json.dumps(request.json)))
-        request_id = cursor.fetchone()[0]
+        # Wake up the daemon; the notification is delivered on commit.
+        cursor.execute("NOTIFY %s" % TRANSPLANT_CHANNEL)
         dbconn.commit()
 
         return jsonify({"request_id": request_id})
@@ -318,39 +578,265 @@ def autoland():
         return make_response(jsonify({"error": "Internal Error: %s" % e}), 500)
 
 
-@app.route("/autoland/status/<request_id>")
-def autoland_status(request_id):
-    if not config.testing():
-        abort(404)
+@app.route("/autoland/batch", methods=["POST"])
+def autoland_batch():
+    """
+    Autoland several patches with a single request.
+
+    Takes a JSON array of requests, each in a format accepted by /autoland,
+    and returns a result for each of them in order; either the request_id of
+    the accepted request or an error:
 
-    dbconn = get_dbconn()
-    cursor = dbconn.cursor()
+    {
+      "results": [
+        {"request_id": 1},
+        {"error": "Bad request: bad pingback_url"}
+      ]
+    }
+
+    Valid requests are accepted even if other requests in the batch are not.
+    """
+    require_auth()
+
+    batch = request.json
+    if not isinstance(batch, list):
+        return make_response(jsonify({"error": "Bad request: expected a list"}), 400)
+    if len(batch) > MAX_BATCH_SIZE:
+        error = "Bad request: at most %s requests can be submitted at once" % (
+            MAX_BATCH_SIZE
+        )
+        return make_response(jsonify({"error": error}), 400)
 
+    results = [None] * len(batch)
+    valid = []
+    seen = set()
+    for index, request_json in enumerate(batch):
+        try:
+            validate_request(request_json)
+        except ValueError as e:
+            app.logger.warn("Bad Request from %s: %s" % (request.remote_addr, e))
+            results[index] = {"error": "Bad request: %s" % e}
+            continue
+
+        key = (request_json["rev"], request_json["destination"])
+        if key in seen:
+            results[index] = {"error": in_progress_error(request_json)}
+            continue
+        seen.add(key)
+        valid.append(index)
+
+    if valid:
+        try:
+            dbconn = get_dbconn()
+            cursor = dbconn.cursor()
+
+            # Insert all the valid requests with a single statement, returning
+            # the id of each, or NULL for those which conflict with requests
+            # already in progress.
+            query = """
+                WITH items AS (
+                    SELECT *
+                      FROM unnest(%(destinations)s::text[], %(requests)s::text[])
+                           WITH ORDINALITY AS i(destination, request, ordinal)
+                ), inserted AS (
+                    INSERT INTO Transplant (destination, request)
+                    SELECT destination, request::jsonb
+                      FROM items
+                     ORDER BY ordinal
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, request->>'rev' AS rev, destination
+                )
+                SELECT items.ordinal, inserted.id
+                  FROM items
+                       LEFT JOIN inserted
+                       ON inserted.rev = items.request::jsonb->>'rev'
+                          AND inserted.destination = items.destination
+                 ORDER BY items.ordinal
+            """
+            cursor.execute(
+                query,
+                {
+                    "destinations": [batch[i]["destination"] for i in valid],
+                    "requests": [json.dumps(batch[i]) for i in valid],
+                },
+            )
+            inserted = False
+            for item, request_id in cursor.fetchall():
+                index = valid[item - 1]
+                if request_id is None:
+                    results[index] = {"error": in_progress_error(batch[index])}
+                else:
+                    app.logger.info(
+                        "received transplant request: %s" % json.dumps(batch[index])
+                    )
+                    results[index] = {"request_id": request_id}
+                    inserted = True
+
+            if inserted:
+                # Wake up the daemon; the notification is delivered on commit.
+                cursor.execute("NOTIFY %s" % TRANSPLANT_CHANNEL)
+            dbconn.commit()
+        except psycopg2.Error as e:
+            msg = "Database error trying to land batch: %s %s" % (e.pgcode, e.pgerror)
+            app.logger.error(msg)
+            return make_response(jsonify({"error": msg}), 500)
+        except Exception as e:
+            app.logger.exception(e)
+            return make_response(jsonify({"error": "Internal Error: %s" % e}), 500)
+
+    return jsonify({"results": results})
+
+
+def transplant_status(destination, req, landed, result):
+    status = req.copy()
+    del status["pingback_url"]
+    status["destination"] = destination
+    status["landed"] = landed
+    status["result"] = result if landed else ""
+    status["error_msg"] = result if not landed else ""
+    return status
+
+
+def get_statuses(request_ids):
+    """Returns the status of each of the requests which exist, keyed by id."""
+    cursor = get_dbconn().cursor()
     query = """
-        select destination, request, landed, result
+        select id, destination, request, landed, result
         from Transplant
-        where id = %(request_id)s
+        where id = any(%(request_ids)s)
+    """
+    cursor.execute(query, {"request_ids": request_ids})
+    return dict((row[0], transplant_status(*row[1:])) for row in cursor.fetchall())
+
+
+def wait_for_statuses(request_ids, wait):
+    """Returns the status of the requests once one of them finishes.
+
+    Returns straight away if none of the requests are pending, otherwise as
+    soon as any of the pending requests lands or fails, or after waiting for
+    up to wait seconds.
+    """
+    deadline = time.time() + wait
+    waiting_for = None
+    with STATUS_LISTENER.watch(request_ids) as changed:
+        while True:
+            statuses = get_statuses(request_ids)
+            pending = set(
+                request_id
+                for request_id, status in statuses.items()
+                if status["landed"] is None
+            )
+            if waiting_for is None:
+                waiting_for = pending
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not pending or waiting_for - pending:
+                return statuses
+
+            # Don't hold on to a pooled connection while waiting.
+            release_dbconn()
+            changed.wait(remaining)
+            changed.clear()
+
+
+@app.route("/autoland/status")
+@app.route("/autoland/status/<request_id>")
+def autoland_status(request_id=None):
+    """
+    Returns the status of an autoland request.
+
+    The status of several requests can be fetched at once with
+    /autoland/status?ids=1,2,3, which returns the status of each request
+    keyed by its id, or null for requests which don't exist.
+
+    With ?wait=N the response is delayed for up to N seconds until a pending
+    request has landed or failed.
+
+    Responses have an ETag; requests with a matching If-None-Match header
+    get a 304 response.
     """
+    require_auth()
 
     try:
-        cursor.execute(query, ({"request_id": int(request_id)}))
+        wait = float(request.args.get("wait", 0))
+        if math.isnan(wait) or math.isinf(wait):
+            raise ValueError("wait must be finite")
     except ValueError:
-        abort(404)
+        return make_response(jsonify({"error": "Bad request: invalid wait"}), 400)
+    wait = min(max(wait, 0), STATUS_MAX_WAIT)
 
-    row = cursor.fetchone()
-    if row:
-        destination, req, landed, result = row
+    if request_id is None:
+        try:
+            request_ids = [int(i) for i in request.args.get("ids", "").split(",")]
+        except ValueError:
+            return make_response(jsonify({"error": "Bad request: invalid ids"}), 400)
+    else:
+        try:
+            request_ids = [int(request_id)]
+        except ValueError:
+            abort(404)
+
+    if wait:
+        statuses = wait_for_statuses(request_ids, wait)
+    else:
+        statuses = get_statuses(request_ids)
+
+    if request_id is None:
+        response = jsonify(
+            {"statuses": dict((str(i), statuses.get(i)) for i in request_ids)}
+        )
+    elif statuses:
+        response = jsonify(statuses[request_ids[0]])
+    else:
+        abort(404)
 
-        status = req.copy()
-        del status["pingback_url"]
-        status["destination"] = destination
-        status["landed"] = landed
-        status["result"] = result if landed else ""
-        status["error_msg"] = result if not landed else ""
+    # Clients have to revalidate, the status changes when the request lands.
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
 
-        return jsonify(status)
 
-    abort(404)
+def pingback_stats():
+    """Returns delivery metrics and the number of queued updates per host."""
+    cursor = get_dbconn().cursor()
+    query = """
+        select coalesce(s.host, q.host), coalesce(s.state, 'closed'),
+               coalesce(s.delivered, 0), coalesce(s.failures, 0),
+               coalesce(s.latency_total, 0), coalesce(s.latency_max, 0),
+               s.last_failure, s.next_attempt_at, coalesce(q.depth, 0)
+        from PingbackStats s
+        full outer join (
+            select host, count(*) as depth
+            from MozreviewUpdate
+            where host is not null
+            group by host
+        ) q on (q.host = s.host)
+    """
+    cursor.execute(query)
+
+    stats = {}
+    for row in cursor.fetchall():
+        host, state, delivered, failures, latency_total, latency_max = row[:6]
+        last_failure, next_attempt_at, depth = row[6:]
+        attempts = delivered + failures
+        stats[host] = {
+            "state": state,
+            "delivered": delivered,
+            "failures": failures,
+            "latency_mean": latency_total / attempts if attempts else 0.0,
+            "latency_max": latency_max,
+            "last_failure": last_failure and last_failure.isoformat(),
+            "next_attempt_at": next_attempt_at and next_attempt_at.isoformat(),
+            "queue_depth": depth,
+        }
+    return stats
+
+
+@app.route("/autoland/stats")
+def autoland_stats():
+    """Returns database connection pool utilisation and pingback metrics."""
+    require_auth()
+    return jsonify({"database_pool": get_pool().stats(), "pingbacks": pingback_stats()})
 
 
 @app.route("/")
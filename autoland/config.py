@@ -41,12 +41,17 @@ def get_repo(name):
     # Returns the configuration of a repository, containing the full path
     # to the repo, and the official name of the tree which can be fed into
     # treestatus.  'path' is guaranteed to be a path, 'tree' may be None.
+    # 'head_file' is the optional path of a file tracking the node of the
+    # upstream repository's head.  'pool_size' is the number of working
+    # copies of the repo transplants can use concurrently.
     repos = get("repos", [])
 
-    repo = {"path": None, "tree": None}
+    repo = {"path": None, "tree": None, "head_file": None, "pool_size": 1}
     if name in repos:
         repo["path"] = repos[name].get("path")
         repo["tree"] = repos[name].get("tree")
+        repo["head_file"] = repos[name].get("head_file")
+        repo["pool_size"] = max(repos[name].get("pool_size", 1), 1)
 
     # Default to paths under /repos/
     if not repo["path"]:
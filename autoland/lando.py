@@ -3,6 +3,7 @@ import urlparse
 
 import config
 import requests
+from sessions import PINGBACK_SESSIONS
 
 logger = logging.getLogger("autoland")
 
@@ -24,7 +25,7 @@ class LandoPingback(object):
                 auth_config = config.get("pingback").get(hostname)
                 self.auth[hostname] = auth_config["api-key"]
 
-            res = requests.post(
+            res = PINGBACK_SESSIONS.post(
                 pingback_url,
                 data=data,
                 headers={
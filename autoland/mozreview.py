@@ -2,6 +2,7 @@ import urlparse
 
 import config
 import requests
+from sessions import PINGBACK_SESSIONS
 
 API_KEY_LOGIN_PATH = (
     "/api/extensions/mozreview.extension.MozReviewExtension/" "bugzilla-api-key-logins/"
@@ -42,6 +43,10 @@ class BugzillaAuth(object):
         """Basic HTTP auth credentials, as user/pass tuple."""
         return None
 
+    def reset(self, pingback_url):
+        """Discards any cached credentials after a login failure."""
+        pass
+
 
 class BugzillaAuthPassword(BugzillaAuth):
     """Username/password authentication.  Used in dev and test."""
@@ -69,7 +74,7 @@ class BugzillaAuthApiKey(BugzillaAuth):
                 "username": self._config["user"],
                 "api_key": self._config["api-key"],
             }
-            res = requests.post(urlparse.urlunsplit(url_parts), data=data)
+            res = PINGBACK_SESSIONS.post(urlparse.urlunsplit(url_parts), data=data)
             if res.status_code != 201:
                 raise BugzillaAuthException("API-Key authentication failed")
             self._cookies[host] = "rbsessionid=%s" % res.cookies["rbsessionid"]
@@ -78,6 +83,10 @@ class BugzillaAuthApiKey(BugzillaAuth):
         headers["Cookie"] = self._cookies[host]
         return headers
 
+    def reset(self, pingback_url):
+        """Log in again next time, the session has expired."""
+        self._cookies.pop(urlparse.urlparse(pingback_url).netloc, None)
+
 
 class MozReviewPingback(object):
     """Handle updating MozReview/RB requests."""
@@ -102,13 +111,14 @@ class MozReviewPingback(object):
         """Sends the 'data' to the 'pingback_url', handing auth and errors"""
         try:
             auth = self._auth_for(pingback_url)
-            res = requests.post(
+            res = PINGBACK_SESSIONS.post(
                 pingback_url,
                 data=data,
                 headers=auth.headers(pingback_url),
                 auth=auth.http_auth(),
             )
             if res.status_code == 401:
+                auth.reset(pingback_url)
                 raise BugzillaAuthException("Login failure")
             return res.status_code, res.text
         except BugzillaAuthException as e:
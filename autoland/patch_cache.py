@@ -0,0 +1,179 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import config
+
+# default location and size of the cache; overridden by "patch_cache_dir" and
+# "patch_cache_max_size" in config.json.  A max size of 0 disables the cache.
+PATCH_CACHE_DIR = os.path.join(os.path.expanduser("~"), "patch-cache")
+PATCH_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+logger = logging.getLogger("autoland")
+
+
+def _hash(value):
+    return hashlib.sha256(value).hexdigest()
+
+
+class PatchCache(object):
+    """An on-disk cache of downloaded patches.
+
+    Patches are stored under the hash of their url and ETag, and the ETag of
+    the most recent download of each url is recorded, so a patch can be
+    revalidated with a conditional request instead of being downloaded again.
+    Entries are written to a temporary file then renamed into place, so a
+    partially written patch is never used.  The least recently used entries
+    are evicted once the cache grows beyond its maximum size.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _path():
+        return config.get("patch_cache_dir", PATCH_CACHE_DIR)
+
+    @staticmethod
+    def _max_size():
+        return config.get("patch_cache_max_size", PATCH_CACHE_MAX_SIZE)
+
+    def _index_file(self, url):
+        return os.path.join(self._path(), "%s.etag" % _hash(url))
+
+    def _entry_file(self, url, etag):
+        return os.path.join(self._path(), "%s.%s.patch" % (_hash(url), _hash(etag)))
+
+    def etag(self, url):
+        """Returns the ETag of the cached copy of the url, or None."""
+        if not self._max_size():
+            return None
+        try:
+            with open(self._index_file(url)) as f:
+                etag = f.read()
+        except IOError:
+            return None
+        if not os.path.exists(self._entry_file(url, etag)):
+            return None
+        return etag
+
+    def open(self, url, etag):
+        """Returns the cached patch, or None if it has been evicted."""
+        entry_file = self._entry_file(url, etag)
+        try:
+            f = open(entry_file, "rb")
+        except IOError:
+            return None
+
+        # Eviction is by modification time.
+        try:
+            os.utime(entry_file, None)
+        except OSError:
+            pass
+        self._record(hit=True)
+        return f
+
+    def store(self, url, etag, patch_file):
+        """Adds the patch to the cache.
+
+        The patch is copied from patch_file, which is returned positioned at
+        the start.
+        """
+        if not self._max_size():
+            return patch_file
+        self._record(hit=False)
+        if not etag:
+            return patch_file
+
+        path = self._path()
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        temp_name = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=path, delete=False) as f:
+                temp_name = f.name
+                shutil.copyfileobj(patch_file, f)
+            os.rename(temp_name, self._entry_file(url, etag))
+
+            with tempfile.NamedTemporaryFile(dir=path, delete=False) as f:
+                temp_name = f.name
+                f.write(etag)
+            os.rename(temp_name, self._index_file(url))
+        except (IOError, OSError) as e:
+            # A failure to cache the patch shouldn't fail the landing.
+            logger.error("failed to cache %s: %s" % (url, e))
+            if temp_name and os.path.exists(temp_name):
+                os.unlink(temp_name)
+
+        patch_file.seek(0)
+        self._evict()
+        return patch_file
+
+    def _record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            hits, misses = self.hits, self.misses
+        logger.info(
+            "patch cache %s (%s hits, %s misses)"
+            % ("hit" if hit else "miss", hits, misses)
+        )
+
+    def _evict(self):
+        """Removes the least recently used patches beyond the maximum size."""
+        path = self._path()
+        with self._lock:
+            entries = []
+            for name in os.listdir(path):
+                if not name.endswith(".patch"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+
+            size = sum(entry[1] for entry in entries)
+            for mtime, entry_size, name in sorted(entries):
+                if size <= self._max_size():
+                    break
+                try:
+                    os.unlink(os.path.join(path, name))
+                except OSError:
+                    pass
+                else:
+                    self._evict_index(path, name)
+                size -= entry_size
+
+    @staticmethod
+    def _evict_index(path, name):
+        """Removes the url's ETag index if it refers to the evicted entry."""
+        # Entries are named <url hash>.<etag hash>.patch
+        url_hash, etag_hash = name.split(".")[:2]
+        index_file = os.path.join(path, "%s.etag" % url_hash)
+        try:
+            with open(index_file) as f:
+                if _hash(f.read()) != etag_hash:
+                    return
+            os.unlink(index_file)
+        except (IOError, OSError):
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+PATCH_CACHE = PatchCache()
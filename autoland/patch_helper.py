@@ -12,118 +12,129 @@ HEADER_NAMES = (
     "Diff Start Line",
     "Fail HG Import",
 )
+HEADER_RES = [
+    (name.lower(), re.compile(r"^#\s+" + re.escape(name) + r"\s+(.*)", re.IGNORECASE))
+    for name in HEADER_NAMES
+]
 DIFF_LINE_RE = re.compile(r"^diff\s+\S+\s+\S+")
 
+# size of the chunks the diff and whole patch are copied in
+COPY_CHUNK_SIZE = 64 * 1024
+
 
 class PatchHelper(object):
-    """Helper class for parsing Mercurial patches/exports."""
+    """Helper class for parsing Mercurial patches/exports.
+
+    The patch is parsed once, recording the offsets of the commit description
+    and the start of the diff, which are then copied directly from the file.
+    Only the lines before the diff are read when parsing.
+    """
 
     def __init__(self, fileobj):
         self.patch = fileobj
         self.headers = {}
         self.header_end_line_no = 0
-        self._parse_header()
-
-        # "Diff Start Line" is a lando/transplant extension.
-        self.diff_start_line = self.header("Diff Start Line")
-        if self.diff_start_line:
-            try:
-                self.diff_start_line = int(self.diff_start_line)
-            except ValueError:
-                self.diff_start_line = None
+        self.diff_start_line = None
+        self._description_start = 0
+        self._diff_start = 0
+        self._parse()
+
+    def _lines(self):
+        """Returns an iterator over the lines of the patch from the start.
+
+        Lines are read with readline rather than by iterating over the file;
+        iterating over a file reads ahead, so the rest of the patch couldn't
+        then be copied with read().
+        """
+        self.patch.seek(0)
+        return iter(self.patch.readline, "")
 
     @staticmethod
     def _is_diff_line(line):
         return DIFF_LINE_RE.search(line)
 
     @staticmethod
-    def _header_value(line, prefix):
-        m = re.search(
-            r"^#\s+" + re.escape(prefix) + "\s+(.*)", line, flags=re.IGNORECASE
-        )
-        if not m:
-            return None
-        return m.group(1).strip()
-
-    def _parse_header(self):
-        """Extract header values specified by HEADER_NAMES."""
-        self.patch.seek(0)
-        try:
-            for line in self.patch:
-                if not line.startswith("# "):
-                    break
-                self.header_end_line_no += 1
-                for name in HEADER_NAMES:
-                    value = self._header_value(line, name)
-                    if value:
-                        self.headers[name.lower()] = value
-                        break
-        finally:
-            self.patch.seek(0)
-
-    def header(self, name):
-        """Returns value of the specified header, or None if missing."""
-        return self.headers.get(name.lower())
-
-    def commit_description(self):
-        """Returns the commit description."""
+    def _header_value(line):
+        """Returns the name and value of a header in HEADER_NAMES, or None."""
+        for name, header_re in HEADER_RES:
+            m = header_re.search(line)
+            if m and m.group(1).strip():
+                return name, m.group(1).strip()
+        return None
+
+    def _parse(self):
+        """Extract header values and the offsets of the description and diff."""
         try:
             line_no = 0
-            commit_desc = []
-            for line in self.patch:
+            offset = 0
+            in_header = True
+            for line in self._lines():
                 line_no += 1
 
-                if line_no <= self.header_end_line_no:
-                    continue
+                if in_header:
+                    if line.startswith("# "):
+                        self.header_end_line_no = line_no
+                        header = self._header_value(line)
+                        if header:
+                            self.headers[header[0]] = header[1]
+                        offset += len(line)
+                        continue
+
+                    in_header = False
+                    self._description_start = offset
+
+                    # "Diff Start Line" is a lando/transplant extension.
+                    try:
+                        self.diff_start_line = int(self.header("Diff Start Line"))
+                    except (TypeError, ValueError):
+                        self.diff_start_line = None
 
                 if self.diff_start_line:
                     if line_no == self.diff_start_line:
                         break
-                    commit_desc.append(line)
-                else:
-                    if self._is_diff_line(line):
-                        break
-                    commit_desc.append(line)
+                elif self._is_diff_line(line):
+                    break
+                offset += len(line)
+            else:
+                if in_header:
+                    self._description_start = offset
 
-            return "".join(commit_desc).strip()
+            self._diff_start = offset
         finally:
             self.patch.seek(0)
 
-    def write(self, f):
-        """Writes whole patch to the specified file object."""
+    def header(self, name):
+        """Returns value of the specified header, or None if missing."""
+        return self.headers.get(name.lower())
+
+    def _copy(self, f, start):
+        """Writes the patch from the offset to the end to the file object."""
         try:
+            self.patch.seek(start)
             while 1:
-                buf = self.patch.read(16 * 1024)
+                buf = self.patch.read(COPY_CHUNK_SIZE)
                 if not buf:
                     break
                 f.write(buf)
         finally:
             self.patch.seek(0)
 
+    def commit_description(self):
+        """Returns the commit description."""
+        try:
+            self.patch.seek(self._description_start)
+            return self.patch.read(self._diff_start - self._description_start).strip()
+        finally:
+            self.patch.seek(0)
+
+    def write(self, f):
+        """Writes whole patch to the specified file object."""
+        self._copy(f, 0)
+
     def write_commit_description(self, f):
         """Writes the commit description to the specified file object."""
         f.write(self.commit_description())
 
     def write_diff(self, f):
         """Writes the diff to the specified file object."""
-        try:
-            line_no = 0
-            for line in self.patch:
-                line_no += 1
-
-                if self.diff_start_line:
-                    if line_no == self.diff_start_line:
-                        f.write(line)
-                        break
-                else:
-                    if self._is_diff_line(line):
-                        f.write(line)
-                        break
-
-            while 1:
-                buf = self.patch.read(16 * 1024)
-                if not buf:
-                    break
-                f.write(buf)
-        finally:
-            self.patch.seek(0)
+        self._copy(f, self._diff_start)
@@ -0,0 +1,420 @@
+import Queue
+import datetime
+import logging
+import threading
+import time
+
+import config
+import lando
+import mozreview
+from concurrent import futures
+from sessions import PINGBACK_SESSIONS
+
+# max updates to fetch from the MozreviewUpdate table at a time
+PINGBACK_FETCH_LIMIT = 100
+
+# default number of updates posted to a single host concurrently
+PINGBACK_HOST_CONCURRENCY = 2
+
+# consecutive failures to post to a host before its circuit breaker opens
+PINGBACK_FAILURE_THRESHOLD = 3
+
+# time to wait before retrying an update which failed to post while the
+# host's circuit breaker is closed
+PINGBACK_RETRY_DELAY = datetime.timedelta(seconds=5)
+
+# time the circuit breaker stays open before trying the host again; doubled
+# each time the trial fails, up to PINGBACK_BACKOFF_MAX
+PINGBACK_BACKOFF_BASE = datetime.timedelta(seconds=30)
+PINGBACK_BACKOFF_MAX = datetime.timedelta(minutes=5)
+
+# how often to check for new updates when idle, in seconds
+PINGBACK_POLL_INTERVAL = 1
+
+# how often to log connection reuse and latency of pingbacks
+PINGBACK_STATS_INTERVAL = datetime.timedelta(minutes=10)
+
+logger = logging.getLogger("autoland")
+
+
+class CircuitBreaker(object):
+    """Tracks failures posting to a host, and the updates in flight to it.
+
+    While closed, up to the host's concurrency limit of updates are posted at
+    a time. After PINGBACK_FAILURE_THRESHOLD consecutive failures the breaker
+    opens and nothing is posted to the host until retry_at. It is then
+    half-open: a single update is posted as a trial, closing the breaker if
+    it succeeds, or opening it again for longer if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.failures = 0
+        self.retry_at = None
+
+    def state(self, now):
+        if self.failures < PINGBACK_FAILURE_THRESHOLD:
+            return self.CLOSED
+        if self.retry_at and self.retry_at > now:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def available(self, now):
+        state = self.state(now)
+        if state == self.OPEN:
+            return False
+        if state == self.HALF_OPEN:
+            return self.in_flight == 0
+        return self.in_flight < self.concurrency
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = None
+
+    def failed(self, now):
+        """Records a failure, returning when the update can be retried."""
+        self.failures += 1
+        if self.failures < PINGBACK_FAILURE_THRESHOLD:
+            return now + PINGBACK_RETRY_DELAY
+
+        trials = self.failures - PINGBACK_FAILURE_THRESHOLD
+        delay = min(
+            PINGBACK_BACKOFF_BASE.total_seconds() * 2 ** min(trials, 16),
+            PINGBACK_BACKOFF_MAX.total_seconds(),
+        )
+        self.retry_at = now + datetime.timedelta(seconds=delay)
+        return self.retry_at
+
+
+class PingbackDispatcher(object):
+    """Posts updates from the MozreviewUpdate table to the requesting systems.
+
+    Updates are posted from a thread pool, independently of transplants, with
+    a circuit breaker for each host; a host which is down doesn't hold up
+    updates to other hosts. Updates for a transplant are posted in the order
+    they were recorded.
+
+    The number of attempts to post each update, and when it can next be
+    attempted, are stored with the update so circuit breakers are restored
+    when the daemon restarts. Delivery metrics for each host are kept in the
+    PingbackStats table.
+
+    The dispatcher has its own database connection, which is only used from
+    the dispatcher's thread.
+    """
+
+    def __init__(self, connect, max_workers=8):
+        self.connect = connect
+        self.max_workers = max_workers
+        self.breakers = {}
+        self.in_flight = {}
+        self.results = Queue.Queue()
+        self.mozreview_pingback = mozreview.MozReviewPingback()
+        self.lando_pingback = lando.LandoPingback()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="pingback")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the dispatcher once the updates in flight are posted."""
+        self._running = False
+        if self._thread:
+            self._thread.join()
+
+    def _breaker(self, hostname):
+        if hostname not in self.breakers:
+            concurrency = (
+                config.get("pingback", {})
+                .get(hostname, {})
+                .get("concurrency", PINGBACK_HOST_CONCURRENCY)
+            )
+            self.breakers[hostname] = CircuitBreaker(max(concurrency, 1))
+        return self.breakers[hostname]
+
+    def _restore_breakers(self, dbconn):
+        cursor = dbconn.cursor()
+        query = """
+            select host,max(attempts),max(next_attempt_at)
+            from MozreviewUpdate
+            where host is not null and attempts>0
+            group by host
+        """
+        cursor.execute(query)
+        for hostname, attempts, retry_at in cursor.fetchall():
+            breaker = self._breaker(hostname)
+            breaker.failures = attempts
+            if attempts >= PINGBACK_FAILURE_THRESHOLD:
+                breaker.retry_at = retry_at
+        dbconn.commit()
+
+    def _pingback_for(self, pingback_url, hostname):
+        """Returns the handler for the pingback url, or None to drop it."""
+        if hostname == "localhost":
+            # localhost pingbacks are always a NO-OP; used during development
+            # and testing.
+            return None
+
+        if hostname not in config.get("pingback", {}):
+            logger.error("ignoring pingback to %s: unconfigured" % hostname)
+            return None
+
+        pingback_config = config.get("pingback").get(hostname)
+
+        if pingback_config["type"] == "mozreview":
+            return self.mozreview_pingback
+
+        elif pingback_config["type"] == "lando":
+            return self.lando_pingback
+
+        logger.warning("ignoring pinback to %s: not supported" % hostname)
+        return None
+
+    def _fetch_updates(self, dbconn, now):
+        # Skip hosts which are unavailable, so they don't crowd out updates
+        # to other hosts, and updates which have an earlier update for the
+        # same transplant ahead of them.
+        blocked = [
+            hostname
+            for hostname, breaker in self.breakers.items()
+            if not breaker.available(now)
+        ]
+        cursor = dbconn.cursor()
+        query = """
+            select id,transplant_id,pingback_url,host,data
+            from MozreviewUpdate m
+            where not (id = any(%(in_flight)s))
+                  and (next_attempt_at is null or next_attempt_at<=%(now)s)
+                  and coalesce(host, '') <> all(%(blocked)s)
+                  and not exists (
+                      select 1
+                      from MozreviewUpdate e
+                      where e.transplant_id=m.transplant_id
+                            and e.id<m.id
+                  )
+            order by id
+            limit %(limit)s
+        """
+        cursor.execute(
+            query,
+            {
+                "in_flight": list(self.in_flight),
+                "now": now,
+                "blocked": blocked,
+                "limit": PINGBACK_FETCH_LIMIT,
+            },
+        )
+        rows = cursor.fetchall()
+        dbconn.commit()
+        return rows
+
+    def _post(self, update_id, pingback, pingback_url, data):
+        started = time.time()
+        try:
+            status_code, text = pingback.update(pingback_url, data)
+        except Exception as e:
+            status_code, text = None, str(e)
+        self.results.put((update_id, status_code, text, time.time() - started))
+
+    def _dispatch(self, dbconn, executor):
+        now = datetime.datetime.now()
+        dropped = []
+
+        for (
+            update_id,
+            transplant_id,
+            pingback_url,
+            hostname,
+            data,
+        ) in self._fetch_updates(dbconn, now):
+            pingback = None
+            if pingback_url:
+                pingback = self._pingback_for(pingback_url, hostname)
+            if not pingback:
+                dropped.append([update_id])
+                continue
+
+            breaker = self._breaker(hostname)
+            if not breaker.available(now):
+                continue
+
+            logger.info(
+                "trying to post %s update to: %s for request: %s"
+                % (pingback.name, pingback_url, transplant_id)
+            )
+            breaker.in_flight += 1
+            self.in_flight[update_id] = (hostname, data)
+            executor.submit(self._post, update_id, pingback, pingback_url, data)
+
+        if dropped:
+            cursor = dbconn.cursor()
+            query = """
+                delete from MozreviewUpdate
+                where id=%s
+            """
+            cursor.executemany(query, dropped)
+            dbconn.commit()
+
+    def _record_result(self, cursor, update_id, status_code, text, latency):
+        hostname, data = self.in_flight.pop(update_id)
+        breaker = self._breaker(hostname)
+        breaker.in_flight -= 1
+        now = datetime.datetime.now()
+        stats = {
+            "host": hostname,
+            "delivered": 0,
+            "failures": 0,
+            "latency": latency,
+            "last_failure": None,
+        }
+
+        if status_code in (200, 404):
+            if status_code == 404:
+                # Submitting system "forgot" about this request; delete it
+                # so we can continuing processing pending updates.
+                logger.info("failed: %s - %s" % (status_code, text))
+
+            if breaker.failures:
+                # Forget earlier failures, otherwise the breaker would be
+                # restored after a restart.
+                query = """
+                    update MozreviewUpdate set attempts=0,next_attempt_at=NULL
+                    where host=%s
+                """
+                cursor.execute(query, (hostname,))
+                if breaker.failures >= PINGBACK_FAILURE_THRESHOLD:
+                    logger.info("circuit breaker for %s closed" % hostname)
+            breaker.succeeded()
+
+            # An intermediate update may have been replaced by a newer one
+            # while it was being posted; keep that to post next.
+            query = """
+                delete from MozreviewUpdate
+                where id=%s and data=%s
+            """
+            cursor.execute(query, (update_id, data))
+            stats["delivered"] = 1
+
+        else:
+            # Treat anything else as a transient failure.
+            retry_at = breaker.failed(now)
+            logger.info(
+                "failed: %s - %s; retrying after %s" % (status_code, text, retry_at)
+            )
+            query = """
+                update MozreviewUpdate set attempts=attempts+1,next_attempt_at=%s
+                where id=%s
+            """
+            cursor.execute(query, (retry_at, update_id))
+
+            if breaker.state(now) == CircuitBreaker.OPEN:
+                logger.info(
+                    "circuit breaker for %s open until %s" % (hostname, retry_at)
+                )
+                # Hold back every update to the host until the breaker
+                # half-opens.
+                query = """
+                    update MozreviewUpdate
+                    set next_attempt_at=greatest(next_attempt_at, %s)
+                    where host=%s
+                """
+                cursor.execute(query, (retry_at, hostname))
+
+            stats["failures"] = 1
+            stats["last_failure"] = now
+
+        stats["state"] = breaker.state(now)
+        stats["next_attempt_at"] = breaker.retry_at
+        query = """
+            insert into PingbackStats(host,state,delivered,failures,
+                                      latency_total,latency_max,last_failure,
+                                      next_attempt_at)
+            values(%(host)s,%(state)s,%(delivered)s,%(failures)s,
+                   %(latency)s,%(latency)s,%(last_failure)s,
+                   %(next_attempt_at)s)
+            on conflict (host) do update
+            set state=excluded.state,
+                delivered=PingbackStats.delivered+excluded.delivered,
+                failures=PingbackStats.failures+excluded.failures,
+                latency_total=PingbackStats.latency_total+excluded.latency_total,
+                latency_max=greatest(PingbackStats.latency_max,
+                                     excluded.latency_max),
+                last_failure=coalesce(excluded.last_failure,
+                                      PingbackStats.last_failure),
+                next_attempt_at=excluded.next_attempt_at
+        """
+        cursor.execute(query, stats)
+
+    def _record_results(self, dbconn, timeout):
+        """Records the results of posts, waiting up to timeout for one."""
+        try:
+            result = self.results.get(timeout=timeout)
+        except Queue.Empty:
+            return
+
+        cursor = dbconn.cursor()
+        try:
+            while True:
+                self._record_result(cursor, *result)
+                result = self.results.get_nowait()
+        except Queue.Empty:
+            pass
+        dbconn.commit()
+
+    def _log_stats(self):
+        for host, stats in sorted(PINGBACK_SESSIONS.stats().items()):
+            logger.info(
+                "pingbacks to %s: %s requests, %s connections, %s reused, "
+                "latency mean %.3fs max %.3fs"
+                % (
+                    host,
+                    stats["requests"],
+                    stats["connections"],
+                    stats["reused"],
+                    stats["latency_mean"],
+                    stats["latency_max"],
+                )
+            )
+
+    def _run(self):
+        executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        dbconn = None
+        restored = False
+        next_stats = datetime.datetime.now() + PINGBACK_STATS_INTERVAL
+        try:
+            while self._running or self.in_flight:
+                try:
+                    if datetime.datetime.now() > next_stats:
+                        next_stats = datetime.datetime.now() + PINGBACK_STATS_INTERVAL
+                        self._log_stats()
+
+                    if dbconn is None:
+                        dbconn = self.connect()
+                    if not restored:
+                        self._restore_breakers(dbconn)
+                        restored = True
+
+                    if self._running:
+                        self._dispatch(dbconn, executor)
+
+                    # Wake up as soon as a post finishes.
+                    self._record_results(dbconn, PINGBACK_POLL_INTERVAL)
+                except Exception as e:
+                    logger.exception(e)
+                    if dbconn is not None:
+                        if dbconn.closed:
+                            dbconn = None
+                        else:
+                            dbconn.rollback()
+                    time.sleep(PINGBACK_POLL_INTERVAL)
+        finally:
+            executor.shutdown(wait=True)
@@ -0,0 +1,7 @@
+-- This allows more than one autoland daemon to process requests. Daemons
+-- claim the requests they are working on, and keep the claim alive with a
+-- heartbeat. Claims from a daemon which stops heartbeating expire and the
+-- request is picked up by another daemon.
+alter table transplant add column claimed_by varchar(255);
+alter table transplant add column claim_expires timestamp;
+alter table transplant add column heartbeat timestamp;
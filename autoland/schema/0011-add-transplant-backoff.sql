@@ -0,0 +1,16 @@
+-- This replaces the tight retry loop used when a push race is lost with a
+-- backoff. Requests record how many times they've been attempted and when
+-- they are next due to be attempted. Push attempts and lost push races are
+-- counted for each destination.
+alter table transplant add column attempts integer not null default 0;
+alter table transplant add column next_attempt_at timestamp;
+update transplant set next_attempt_at = last_updated + interval '5 minutes'
+    where landed is null and last_updated is not null;
+
+create table DestinationStats (
+    destination varchar(255) primary key,
+    attempts bigint not null default 0,
+    race_losses bigint not null default 0,
+    last_race_loss timestamp
+);
+grant all privileges on table DestinationStats to autoland;
@@ -0,0 +1,9 @@
+-- This converts the request column to jsonb so it can be indexed, and adds
+-- partial indexes for the queries run against unlanded requests: the
+-- daemon's pending query and the API's in-flight duplicate check. Without
+-- them both are sequential scans over every request ever made.
+alter table transplant alter column request type jsonb using request::jsonb;
+create index transplant_pending_idx on transplant (destination, created)
+    where landed is null;
+create index transplant_in_flight_idx on transplant ((request->>'rev'), destination)
+    where landed is null;
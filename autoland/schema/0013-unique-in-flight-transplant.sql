@@ -0,0 +1,40 @@
+-- This enforces the API's in-flight duplicate check with a unique index, so
+-- concurrent submissions of the same revision can't both be accepted, and
+-- adds the optional client supplied key used to make submissions idempotent.
+--
+-- The old check could race, leaving the same revision in flight more than
+-- once, which would stop the unique index from being created.  The oldest
+-- of these requests is kept and the others are failed as duplicates of it,
+-- with a final update so the requesting system is told.  Stop the daemons
+-- before applying this, so a duplicate which is being landed isn't failed
+-- underneath them.
+with duplicates as (
+    update transplant t
+        set landed = false,
+            result = 'Duplicate of request ' || d.keep_id || ', which is in progress.'
+        from (
+            select id,
+                   first_value(id) over (partition by request->>'rev', destination
+                                         order by created, id) as keep_id
+            from transplant
+            where landed is null
+        ) d
+        where t.id = d.id and d.id <> d.keep_id
+        returning t.id, t.destination, t.request, t.result
+)
+insert into mozreviewupdate (transplant_id, data)
+    select id,
+           json_build_object('request_id', id,
+                             'tree', request->>'tree',
+                             'rev', request->>'rev',
+                             'destination', destination,
+                             'trysyntax', coalesce(request->>'trysyntax', ''),
+                             'landed', false,
+                             'error_msg', result,
+                             'result', '')::text
+    from duplicates;
+drop index transplant_in_flight_idx;
+create unique index transplant_in_flight_idx
+    on transplant ((request->>'rev'), destination) where landed is null;
+alter table transplant add column idempotency_key varchar(255);
+create unique index transplant_idempotency_key_idx on transplant (idempotency_key);
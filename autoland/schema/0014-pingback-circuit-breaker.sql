@@ -0,0 +1,27 @@
+-- This stores the pingback url and host with each update, so the pingback
+-- dispatcher doesn't need to join against transplant, and tracks failed
+-- attempts to post each update so the state of each host's circuit breaker
+-- survives a restart.  PingbackStats holds per-host delivery metrics.
+alter table mozreviewupdate add column pingback_url text;
+alter table mozreviewupdate add column host varchar(255);
+alter table mozreviewupdate add column attempts integer not null default 0;
+alter table mozreviewupdate add column next_attempt_at timestamp;
+update mozreviewupdate
+   set pingback_url = transplant.request->>'pingback_url',
+       host = lower(substring(transplant.request->>'pingback_url'
+                              from '^[A-Za-z]+://(?:[^@/]*@)?([^/:?#]+)'))
+  from transplant
+ where transplant.id = mozreviewupdate.transplant_id;
+create index mozreviewupdate_transplant_idx on mozreviewupdate (transplant_id, id);
+
+create table pingbackstats (
+    host varchar(255) primary key,
+    state varchar(16) not null default 'closed',
+    delivered bigint not null default 0,
+    failures bigint not null default 0,
+    latency_total double precision not null default 0,
+    latency_max double precision not null default 0,
+    last_failure timestamp,
+    next_attempt_at timestamp
+);
+grant all privileges on table pingbackstats to autoland;
@@ -0,0 +1,6 @@
+-- This marks updates which report the final result of a transplant.  A
+-- transplant has at most one undelivered intermediate update, which is
+-- replaced by newer intermediate updates.
+alter table mozreviewupdate add column final boolean not null default true;
+create unique index mozreviewupdate_intermediate_idx on mozreviewupdate (transplant_id)
+    where not final;
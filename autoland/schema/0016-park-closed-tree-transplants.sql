@@ -0,0 +1,6 @@
+-- This parks requests which can't land because their tree is closed.  Parked
+-- requests aren't claimed again until the daemon sees the tree reopen, rather
+-- than being retried while the tree is still closed.
+alter table transplant add column parked_tree varchar(255);
+create index transplant_parked_idx on transplant (parked_tree)
+    where landed is null and parked_tree is not null;
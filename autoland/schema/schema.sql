@@ -4,19 +4,61 @@ grant usage, select on sequence request_sequence to autoland;
 create table Transplant (
     id bigint default nextval('request_sequence'),
     destination varchar(255),
-    request json,
+    request jsonb,
     landed boolean,
     result text,
     last_updated timestamp,
     created timestamp not null default current_timestamp,
+    claimed_by varchar(255),
+    claim_expires timestamp,
+    heartbeat timestamp,
+    attempts integer not null default 0,
+    next_attempt_at timestamp,
+    idempotency_key varchar(255),
+    parked_tree varchar(255),
     primary key(id)
 );
 grant all privileges on table Transplant to autoland;
+create index transplant_pending_idx on Transplant (destination, created)
+    where landed is null;
+create unique index transplant_in_flight_idx
+    on Transplant ((request->>'rev'), destination) where landed is null;
+create unique index transplant_idempotency_key_idx on Transplant (idempotency_key);
+create index transplant_parked_idx on Transplant (parked_tree)
+    where landed is null and parked_tree is not null;
 
 create table MozreviewUpdate (
     id bigserial primary key,
     transplant_id bigint references transplant(id),
-    data text
+    data text,
+    pingback_url text,
+    host varchar(255),
+    attempts integer not null default 0,
+    next_attempt_at timestamp,
+    final boolean not null default true
 );
 grant all privileges on table MozreviewUpdate to autoland;
 grant usage, select on sequence mozreviewupdate_id_seq to autoland;
+create index mozreviewupdate_transplant_idx on MozreviewUpdate (transplant_id, id);
+create unique index mozreviewupdate_intermediate_idx on MozreviewUpdate (transplant_id)
+    where not final;
+
+create table DestinationStats (
+    destination varchar(255) primary key,
+    attempts bigint not null default 0,
+    race_losses bigint not null default 0,
+    last_race_loss timestamp
+);
+grant all privileges on table DestinationStats to autoland;
+
+create table PingbackStats (
+    host varchar(255) primary key,
+    state varchar(16) not null default 'closed',
+    delivered bigint not null default 0,
+    failures bigint not null default 0,
+    latency_total double precision not null default 0,
+    latency_max double precision not null default 0,
+    last_failure timestamp,
+    next_attempt_at timestamp
+);
+grant all privileges on table PingbackStats to autoland;
@@ -0,0 +1,93 @@
+import threading
+import urlparse
+
+import requests
+
+# (connect, read) timeouts for requests made through HostSessions, in seconds
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# max connections kept alive to each host
+POOL_MAXSIZE = 10
+
+
+class HostSessions(object):
+    """Keep-alive requests sessions, one per host.
+
+    Requests to the same host reuse pooled connections rather than setting up
+    a new connection for every request, and are always made with a timeout.
+    The number of requests, the connections made for them, and their latency
+    are recorded per host.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._latency = {}
+
+    def session(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=POOL_MAXSIZE
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+                self._latency[host] = [0, 0.0, 0.0]
+            return self._sessions[host]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        res = self.session(url).request(method, url, **kwargs)
+
+        host = urlparse.urlparse(url).netloc
+        elapsed = res.elapsed.total_seconds()
+        with self._lock:
+            latency = self._latency[host]
+            latency[0] += 1
+            latency[1] += elapsed
+            latency[2] = max(latency[2], elapsed)
+        return res
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """Returns the connection reuse and latency of requests to each host."""
+        stats = {}
+        with self._lock:
+            sessions = self._sessions.items()
+            latencies = dict((host, list(l)) for host, l in self._latency.items())
+
+        for host, session in sessions:
+            connections = 0
+            pool_requests = 0
+            for adapter in set(session.adapters.values()):
+                # urllib3's pool container refuses to be iterated over.
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    connections += pool.num_connections
+                    pool_requests += pool.num_requests
+
+            count, total, slowest = latencies[host]
+            stats[host] = {
+                "requests": count,
+                "connections": connections,
+                "reused": max(pool_requests - connections, 0),
+                "latency_mean": total / count if count else 0.0,
+                "latency_max": slowest,
+            }
+        return stats
+
+
+# Shared by the pingback handlers.
+PINGBACK_SESSIONS = HostSessions()
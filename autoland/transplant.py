@@ -3,7 +3,10 @@ import json
 import logging
 import os
 import re
+import shutil
 import tempfile
+import threading
+import time
 import urlparse
 
 import boto3
@@ -11,10 +14,50 @@ import config
 import hglib
 import requests
 from botocore.exceptions import ClientError
+from concurrent import futures
+from patch_cache import PATCH_CACHE
 from patch_helper import PatchHelper
 
 REPO_CONFIG = {}
 
+# Command servers are restarted after running this many commands, to bound
+# the growth of mercurial's in-process caches.
+HG_CLIENT_MAX_COMMANDS = 500
+
+# Failures which leave the repository or command server in an unknown state;
+# the command server is restarted rather than being reused.
+HG_UNKNOWN_STATE_ERRORS = (
+    "abandoned transaction found",
+    "hg recover",
+    "interrupted",
+    "lock held by",
+    "timed out waiting for lock",
+)
+
+# Network operations made to update from upstream without a remote head
+# tracker: an identify, then a pull.
+UPSTREAM_NETWORK_OPS = 2
+
+# Upstream head hints older than this are ignored.
+UPSTREAM_HEAD_HINT_MAX_AGE = 60  # seconds
+
+# Downloaded patches larger than this are spooled to disk rather than held in
+# memory; overridden by "patch_spool_max_memory" in config.json.
+PATCH_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+# Largest patch which will be downloaded; overridden by "patch_max_size" in
+# config.json.
+PATCH_MAX_SIZE = 1024 * 1024 * 1024
+
+PATCH_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# (connect, read) timeouts for downloading patches from urls, in seconds
+PATCH_DOWNLOAD_TIMEOUT = (3.05, 60)
+
+# Max patches downloaded concurrently from a single bucket (or host, for http
+# urls); overridden by "patch_downloads_per_bucket" in config.json.
+PATCH_DOWNLOADS_PER_BUCKET = 4
+
 logger = logging.getLogger("autoland")
 
 
@@ -42,10 +85,223 @@ class HgCommandError(Exception):
         super(self.__class__, self).__init__(message)
 
 
+def read_upstream_head_hint(path):
+    """Returns the upstream head recorded in path, or None.
+
+    The file is expected to contain the node of the upstream repository's
+    head, and be updated whenever upstream is pushed to.
+    """
+    if not path:
+        return None
+    try:
+        if time.time() - os.stat(path).st_mtime > UPSTREAM_HEAD_HINT_MAX_AGE:
+            return None
+        with open(path) as f:
+            node = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if not re.match(r"^[0-9a-f]{40}$", node):
+        return None
+    return node
+
+
+class HgClientPool(object):
+    """Long-lived hglib command servers, keyed by repository path.
+
+    Starting a command server reloads extensions, hgrc and the repository's
+    caches, so servers are reused between transplants rather than started
+    for each one.
+    """
+
+    CONFIGS = ["ui.interactive=False", "extensions.purge="]
+
+    def __init__(self, max_commands=HG_CLIENT_MAX_COMMANDS):
+        self.max_commands = max_commands
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._commands = {}
+
+    def acquire(self, path):
+        """Returns a healthy command server for the repository at path."""
+        while True:
+            with self._lock:
+                idle = self._idle.get(path)
+                client = idle.pop() if idle else None
+
+            if client is None:
+                logger.info("starting command server for %s" % path)
+                client = hglib.open(path, encoding="utf-8", configs=self.CONFIGS)
+                with self._lock:
+                    self._commands[client] = 0
+                return client
+
+            if self._is_healthy(client):
+                return client
+            logger.info("discarding unhealthy command server for %s" % path)
+            self._close(client)
+
+    def release(self, path, client, discard=False):
+        """Returns a command server to the pool, or closes it if discarding."""
+        with self._lock:
+            commands = self._commands.get(client, 0)
+        if commands >= self.max_commands:
+            logger.info(
+                "recycling command server for %s after %s commands" % (path, commands)
+            )
+            discard = True
+
+        if discard:
+            self._close(client)
+        else:
+            with self._lock:
+                self._idle.setdefault(path, []).append(client)
+
+    def record_command(self, client):
+        with self._lock:
+            self._commands[client] = self._commands.get(client, 0) + 1
+
+    def close_all(self):
+        with self._lock:
+            clients = [c for idle in self._idle.values() for c in idle]
+            self._idle = {}
+        for client in clients:
+            self._close(client)
+
+    @staticmethod
+    def _is_healthy(client):
+        if client.server is None or client.server.poll() is not None:
+            return False
+        try:
+            client.root()
+        except (hglib.error.ServerError, hglib.error.CommandError, IOError):
+            return False
+        return True
+
+    def _close(self, client):
+        with self._lock:
+            self._commands.pop(client, None)
+        try:
+            client.close()
+        except Exception as e:
+            logger.debug("failed to close command server: %s" % e)
+
+
+HG_CLIENTS = HgClientPool()
+
+
+class WorkingCopyPool(object):
+    """Leases working copies of each source tree to transplants.
+
+    The first working copy of a tree is the repository at the configured
+    path.  Trees with a "pool_size" greater than one get additional working
+    copies, cloned locally from the first one.  Local clones hardlink the
+    store so they are cheap to create; `hg share` can't be used as stripping
+    in one share would strip changesets being worked on in another.
+
+    Working copies are reset in the background once they are released, so
+    transplants don't wait on the cleanup of the previous transplant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._free = {}
+        self._created = {}
+        self._resetting = 0
+
+    def lease(self, tree):
+        """Returns the path of a clean working copy for tree, blocking until
+        one is available."""
+        repo_config = config.get_repo(tree)
+        with self._cond:
+            while True:
+                free = self._free.get(tree)
+                if free:
+                    return free.pop()
+                created = self._created.get(tree, 0)
+                if created < repo_config["pool_size"]:
+                    self._created[tree] = created + 1
+                    break
+                self._cond.wait(1)
+
+        try:
+            return self._create(repo_config["path"], created)
+        except Exception:
+            with self._cond:
+                self._created[tree] -= 1
+                self._cond.notify_all()
+            raise
+
+    def release(self, tree, path, reset=None):
+        """Returns a working copy to the pool once reset has been called."""
+
+        def finish():
+            try:
+                if reset:
+                    reset()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self._cond:
+                    self._free.setdefault(tree, []).append(path)
+                    if reset:
+                        self._resetting -= 1
+                    self._cond.notify_all()
+
+        if reset:
+            with self._cond:
+                self._resetting += 1
+            threading.Thread(target=finish, name="reset %s" % path).start()
+        else:
+            finish()
+
+    def wait_for_resets(self):
+        with self._cond:
+            while self._resetting:
+                self._cond.wait(1)
+
+    @staticmethod
+    def _create(source, index):
+        if index == 0:
+            return source
+
+        path = "%s-%s" % (source, index)
+        if not os.path.exists(os.path.join(path, ".hg")):
+            logger.info("cloning working copy %s from %s" % (path, source))
+            hglib.clone(source, path, noupdate=True)
+
+        # The clone needs the same paths and extensions as its source.
+        hgrc = os.path.join(source, ".hg", "hgrc")
+        if os.path.exists(hgrc):
+            shutil.copy(hgrc, os.path.join(path, ".hg", "hgrc"))
+
+        return path
+
+
+WORKING_COPIES = WorkingCopyPool()
+
+
+def hg_state_unknown(exc):
+    """Returns True if exc may have left a command server in a bad state."""
+    if isinstance(exc, (hglib.error.ServerError, IOError, OSError)):
+        return True
+    if isinstance(exc, (HgCommandError, hglib.error.CommandError)):
+        output = getattr(exc, "out", None) or str(exc)
+        return any(error in output for error in HG_UNKNOWN_STATE_ERRORS)
+    return False
+
+
+class TransplantTrainError(Exception):
+    """A transplant in a landing train could not be applied."""
+
+    def __init__(self, transplant, message):
+        super(TransplantTrainError, self).__init__(message)
+        self.transplant = transplant
+
+
 class Transplant(object):
     """Transplant a specified revision and ancestors to the specified tree."""
 
-    def __init__(self, tree, destination, rev):
+    def __init__(self, tree, destination, rev, requester=None):
         # These values can appear in command arguments. Don't let unicode leak
         # into these.
         assert isinstance(tree, str), "tree arg is not str"
@@ -55,20 +311,61 @@ class Transplant(object):
         self.tree = tree
         self.destination = destination
         self.source_rev = rev
-        self.path = config.get_repo(tree)["path"]
+        repo_config = config.get_repo(tree)
+        self.path = None  # leased from WORKING_COPIES on entry
+        self.head_file = repo_config["head_file"]
         self.landing_system_id = None
+        self.requester = requester
+
+        # Network operations made to find and pull the upstream head.
+        self.network_ops = 0
 
     def __enter__(self):
-        configs = ["ui.interactive=False", "extensions.purge="]
-        self.hg_repo = hglib.open(self.path, encoding="utf-8", configs=configs)
+        self.path = WORKING_COPIES.lease(self.tree)
+        try:
+            self.hg_repo = HG_CLIENTS.acquire(self.path)
+            try:
+                self.ssh_config = self._ssh_config()
+            except Exception:
+                HG_CLIENTS.release(self.path, self.hg_repo, discard=True)
+                raise
+        except Exception:
+            WORKING_COPIES.release(self.tree, self.path)
+            raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.network_ops < UPSTREAM_NETWORK_OPS:
+            logger.info(
+                "%s - saved %s upstream network operations"
+                % (self.source_rev, UPSTREAM_NETWORK_OPS - self.network_ops)
+            )
+
+        state_unknown = exc_val is not None and hg_state_unknown(exc_val)
+
+        def reset():
+            discard = state_unknown
+            try:
+                self.clean_repo()
+            except Exception as e:
+                logger.exception(e)
+                discard = True
+            HG_CLIENTS.release(self.path, self.hg_repo, discard=discard)
+
+        WORKING_COPIES.release(self.tree, self.path, reset)
+
+    def _ssh_config(self):
+        # The requester is forwarded to hg.mozilla.org via ssh's SendEnv.
+        # Command servers are shared between requests so it can't be set in
+        # their environment; instead ui.ssh is overridden for each command.
+        if not self.requester:
+            return []
         try:
-            self.clean_repo()
-        except Exception as e:
-            logger.exception(e)
-        self.hg_repo.close()
+            ssh = self.hg_repo.config(["ui.ssh"])[0][2]
+        except (hglib.error.CommandError, IndexError):
+            ssh = "ssh"
+        env = "AUTOLAND_REQUEST_USER=%s" % self.requester.encode("utf-8")
+        return ["--config", "ui.ssh=env %s %s" % (shell_quote([env]), ssh)]
 
     def push_try(self, trysyntax):
         # Don't let unicode leak into command arguments.
@@ -145,7 +442,8 @@ class Transplant(object):
         logger.info("%s $ %s" % (self.source_rev, shell_quote(["hg"] + args)))
         out = hglib.util.BytesIO()
         out_channels = {b"o": out.write, b"e": out.write}
-        ret = self.hg_repo.runcommand(args, {}, out_channels)
+        HG_CLIENTS.record_command(self.hg_repo)
+        ret = self.hg_repo.runcommand(self.ssh_config + args, {}, out_channels)
         out = out.getvalue()
         if out:
             for line in out.rstrip().splitlines():
@@ -195,8 +493,20 @@ class Transplant(object):
         )
 
     def get_remote_head(self):
+        # A recent notification of the upstream head (eg. from a pushlog
+        # hook) lets us avoid asking upstream for it.
+        hint = read_upstream_head_hint(self.head_file)
+        if hint:
+            if not self.is_public_rev(hint):
+                self.run_hg_cmds([["pull", "upstream"]])
+                self.network_ops += 1
+            if self.is_public_rev(hint):
+                return hint[:12]
+            logger.info("ignoring stale upstream head hint: %s" % hint)
+
         # Obtain remote head. We assume there is only a single head.
         cset = self.run_hg_cmds([["identify", "upstream", "-r", "default"]])
+        self.network_ops += 1
 
         # Output can contain bookmark or branch name after a space. Only take
         # first component.
@@ -208,11 +518,16 @@ class Transplant(object):
     def update_from_upstream(self, remote_rev):
         # Pull "upstream" and update to remote tip.
         cmds = [
-            ["pull", "upstream"],
             ["rebase", "--abort", "-r", remote_rev],
             ["update", "--clean", "-r", remote_rev],
         ]
 
+        # Only pull if we don't already have the remote head, which is
+        # usually the case when retrying or landing consecutive requests.
+        if not self.is_public_rev(remote_rev):
+            cmds.insert(0, ["pull", "upstream"])
+            self.network_ops += 1
+
         for cmd in cmds:
             try:
                 self.run_hg(cmd)
@@ -224,6 +539,13 @@ class Transplant(object):
                 else:
                     raise HgCommandError(cmd, e.out)
 
+    def is_public_rev(self, rev):
+        try:
+            return bool(self.run_hg(["log", "-r", "%s and public()" % rev, "-T", "x"]))
+        except hglib.error.CommandError:
+            # Unknown revision.
+            return False
+
     def rebase(self, base_revision, target_cset):
         # Perform rebase if necessary. Returns tip revision.
         cmd = ["rebase", "-s", base_revision, "-d", target_cset]
@@ -246,8 +568,8 @@ class Transplant(object):
 
 
 class RepoTransplant(Transplant):
-    def __init__(self, tree, destination, rev, commit_descriptions):
-        super(RepoTransplant, self).__init__(tree, destination, rev)
+    def __init__(self, tree, destination, rev, commit_descriptions, requester=None):
+        super(RepoTransplant, self).__init__(tree, destination, rev, requester)
 
         self.landing_system_id = "mozreview"
         self.commit_descriptions = commit_descriptions
@@ -317,13 +639,33 @@ class RepoTransplant(Transplant):
         incoming_descriptions = set(
             [c.encode(self.hg_repo.encoding) for c in self.commit_descriptions.values()]
         )
-        outgoing = self.hg_repo.outgoing("tip", self.destination)
-        outgoing_descriptions = set([commit[5] for commit in outgoing])
+        # Go through run_hg so the connection to the destination is made with
+        # the same ssh command, and requester, as the push.
+        try:
+            out = self.run_hg(
+                [
+                    "outgoing",
+                    "-q",
+                    "-r",
+                    "tip",
+                    "-T",
+                    "{node}\\0{desc}\\0",
+                    self.destination,
+                ]
+            )
+        except hglib.error.CommandError as e:
+            # hg outgoing exits with 1 when there is nothing to push.
+            if e.ret != 1:
+                raise
+            out = b""
+        fields = out.split(b"\0")
+        outgoing = list(zip(fields[0::2], fields[1::2]))
+        outgoing_descriptions = set([desc for node, desc in outgoing])
 
         if incoming_descriptions ^ outgoing_descriptions:
             logger.error("unexpected outgoing commits:")
-            for commit in outgoing:
-                logger.error("outgoing: %s: %s" % (commit[1], commit[5]))
+            for node, desc in outgoing:
+                logger.error("outgoing: %s: %s" % (node, desc))
 
             raise Exception(
                 "We're sorry - something has gone wrong while "
@@ -334,12 +676,38 @@ class RepoTransplant(Transplant):
 
 
 class PatchTransplant(Transplant):
-    def __init__(self, tree, destination, rev, patch_urls, patch=None):
-        super(PatchTransplant, self).__init__(tree, destination, rev)
+    def __init__(self, tree, destination, rev, patch_urls, patch=None, requester=None):
+        super(PatchTransplant, self).__init__(tree, destination, rev, requester)
 
         self.landing_system_id = "lando"
         self.patch_urls = patch_urls
         self.patch = patch
+        self.downloads = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.discard_downloads()
+        super(PatchTransplant, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def start_downloads(self):
+        """Starts downloading all the patches concurrently."""
+        if self.downloads is not None:
+            return
+        if config.testing() and self.patch:
+            return
+        self.downloads = [
+            PATCH_DOWNLOADS.submit(patch_url, self._download)
+            for patch_url in self.patch_urls
+        ]
+
+    def discard_downloads(self):
+        if self.downloads:
+            PATCH_DOWNLOADS.discard(self.downloads)
+        self.downloads = None
+
+    def update_repo(self):
+        # Download the patches while the repo is updated from upstream.
+        self.start_downloads()
+        return super(PatchTransplant, self).update_repo()
 
     def apply_changes(self, target_cset):
         dirty_files = self.dirty_files()
@@ -359,18 +727,20 @@ class PatchTransplant(Transplant):
             self._apply_patch_from_io_buff(io.BytesIO(self.patch))
 
         else:
-            for patch_url in self.patch_urls:
-                if patch_url.startswith("s3://"):
-                    # Download patch from s3 to a temp file.
-                    io_buf = self._download_from_s3(patch_url)
-
-                else:
-                    # Download patch directly from url.  Using a temp file here
-                    # instead of passing the url to 'hg import' to make
-                    # testing's code path closer to production's.
-                    io_buf = self._download_from_url(patch_url)
-
-                self._apply_patch_from_io_buff(io_buf)
+            # Apply the patches in order as their downloads complete.
+            self.start_downloads()
+            try:
+                for patch_url, download in zip(self.patch_urls, self.downloads):
+                    started = time.time()
+                    patch_file = download.result()
+                    logger.info(
+                        "%s - waited %.2fs for %s"
+                        % (self.source_rev, time.time() - started, patch_url)
+                    )
+                    with patch_file:
+                        self._apply_patch_from_io_buff(patch_file)
+            finally:
+                self.discard_downloads()
 
         return self.run_hg(["log", "-r", ".", "-T", "{node}"])
 
@@ -460,9 +830,25 @@ class PatchTransplant(Transplant):
                 + ["--logfile", desc_temp.name]
             )
 
+    @classmethod
+    def _download(cls, patch_url):
+        started = time.time()
+        if patch_url.startswith("s3://"):
+            # Download patch from s3 to a temp file.
+            patch_file = cls._download_from_s3(patch_url)
+
+        else:
+            # Download patch directly from url.  Using a temp file here
+            # instead of passing the url to 'hg import' to make
+            # testing's code path closer to production's.
+            patch_file = cls._download_from_url(patch_url)
+
+        logger.info("downloaded %s in %.2fs" % (patch_url, time.time() - started))
+        return patch_file
+
     @staticmethod
     def _download_from_s3(patch_url):
-        # Download from s3 url specified in self.patch_url, returns io.BytesIO.
+        # Download from s3 url specified in self.patch_url, returns a temp file.
         url = urlparse.urlparse(patch_url)
         bucket = url.hostname
         key = url.path[1:]
@@ -484,18 +870,35 @@ class PatchTransplant(Transplant):
             raise Exception("invalid patch_url")
 
         try:
-            s3 = boto3.client(
-                "s3",
-                aws_access_key_id=bucket_config["aws_access_key_id"],
-                aws_secret_access_key=bucket_config["aws_secret_access_key"],
-            )
-
-            buf = io.BytesIO()
-            s3.download_fileobj(bucket, key, buf)
-            buf.seek(0)  # Seek to the start for consumers.
-            return buf
+            s3 = S3_CLIENTS.get(bucket, bucket_config)
+
+            res = None
+            etag = PATCH_CACHE.etag(patch_url)
+            if etag:
+                # Revalidate the cached copy instead of downloading it again.
+                try:
+                    res = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+                except ClientError as e:
+                    if _http_status(e) != 304:
+                        raise
+                    patch_file = PATCH_CACHE.open(patch_url, etag)
+                    if patch_file:
+                        return patch_file
+            if res is None:
+                res = s3.get_object(Bucket=bucket, Key=key)
+
+            spool = PatchSpool(patch_url)
+            body = res["Body"]
+            try:
+                spool.check_size(res["ContentLength"])
+                patch_file = spool.download(
+                    iter(lambda: body.read(PATCH_DOWNLOAD_CHUNK_SIZE), b"")
+                )
+            finally:
+                body.close()
+            return PATCH_CACHE.store(patch_url, res.get("ETag"), patch_file)
         except ClientError as e:
-            error_code = int(e.response["Error"]["Code"])
+            error_code = _http_status(e)
             if error_code == 404:
                 raise Exception("unable to download %s: file not found" % patch_url)
             if error_code == 403:
@@ -504,7 +907,213 @@ class PatchTransplant(Transplant):
 
     @staticmethod
     def _download_from_url(patch_url):
-        # Download from patch_url, returns io.BytesIO.
-        r = requests.get(patch_url, stream=True)
-        r.raise_for_status()
-        return io.BytesIO(r.content.lstrip())
+        # Download from patch_url, returns a temp file.
+        spool = PatchSpool(patch_url, lstrip=True)
+        etag = PATCH_CACHE.etag(patch_url)
+        headers = {"If-None-Match": etag} if etag else {}
+        r = requests.get(
+            patch_url, headers=headers, stream=True, timeout=PATCH_DOWNLOAD_TIMEOUT
+        )
+        try:
+            if r.status_code == 304:
+                patch_file = PATCH_CACHE.open(patch_url, etag)
+                if patch_file:
+                    return patch_file
+                r.close()
+                r = requests.get(patch_url, stream=True, timeout=PATCH_DOWNLOAD_TIMEOUT)
+
+            r.raise_for_status()
+            if r.headers.get("Content-Length"):
+                spool.check_size(int(r.headers["Content-Length"]))
+            patch_file = spool.download(r.iter_content(PATCH_DOWNLOAD_CHUNK_SIZE))
+            return PATCH_CACHE.store(patch_url, r.headers.get("ETag"), patch_file)
+        finally:
+            r.close()
+
+
+def _http_status(client_error):
+    return client_error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+
+class S3ClientCache(object):
+    """S3 clients shared by all transplants, one per bucket.
+
+    Creating a client loads botocore's service models and sets up a new
+    connection pool, so clients are reused across downloads. A bucket's
+    client is replaced when its credentials in config.json change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, bucket, bucket_config):
+        credentials = (
+            bucket_config["aws_access_key_id"],
+            bucket_config["aws_secret_access_key"],
+        )
+        # Clients are thread safe once created, but creating them isn't.
+        with self._lock:
+            cached = self._clients.get(bucket)
+            if cached is None or cached[0] != credentials:
+                if cached is not None:
+                    logger.info("credentials for bucket %s changed" % bucket)
+                client = boto3.client(
+                    "s3",
+                    aws_access_key_id=credentials[0],
+                    aws_secret_access_key=credentials[1],
+                )
+                cached = self._clients[bucket] = (credentials, client)
+            return cached[1]
+
+
+S3_CLIENTS = S3ClientCache()
+
+
+class PatchDownloader(object):
+    """Downloads patches in the background.
+
+    Each bucket, or host for http urls, has its own thread pool bounding the
+    number of concurrent downloads from it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executors = {}
+
+    def submit(self, patch_url, download):
+        """Returns a future for the result of download(patch_url)."""
+        bucket = urlparse.urlparse(patch_url).netloc
+        with self._lock:
+            if bucket not in self._executors:
+                workers = config.get(
+                    "patch_downloads_per_bucket", PATCH_DOWNLOADS_PER_BUCKET
+                )
+                self._executors[bucket] = futures.ThreadPoolExecutor(
+                    max_workers=max(workers, 1)
+                )
+            executor = self._executors[bucket]
+        return executor.submit(download, patch_url)
+
+    @staticmethod
+    def discard(downloads):
+        """Cancels downloads, closing the files of any which have finished."""
+
+        def close(future):
+            if not future.cancelled() and future.exception() is None:
+                future.result().close()
+
+        for future in downloads:
+            if not future.cancel():
+                future.add_done_callback(close)
+
+
+PATCH_DOWNLOADS = PatchDownloader()
+
+
+class PatchSpool(object):
+    """A temporary file a patch is downloaded into.
+
+    The patch is held in memory until it grows beyond the configured
+    threshold, then spooled to disk. Downloads larger than the configured
+    maximum patch size are aborted.
+    """
+
+    def __init__(self, patch_url, lstrip=False):
+        self.patch_url = patch_url
+        self.lstrip = lstrip
+        self.size = 0
+        self.max_size = config.get("patch_max_size", PATCH_MAX_SIZE)
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=config.get("patch_spool_max_memory", PATCH_SPOOL_MAX_MEMORY)
+        )
+
+    def check_size(self, size):
+        if size > self.max_size:
+            raise Exception(
+                "unable to download %s: patch is larger than %s bytes"
+                % (self.patch_url, self.max_size)
+            )
+
+    def write(self, data):
+        if self.lstrip:
+            # Drop leading whitespace, which may span several chunks.
+            data = data.lstrip()
+            if not data:
+                return
+            self.lstrip = False
+
+        self.size += len(data)
+        self.check_size(self.size)
+        self.file.write(data)
+
+    def download(self, chunks):
+        """Writes the chunks to the file, returning it positioned at the start."""
+        try:
+            for chunk in chunks:
+                self.write(chunk)
+        except Exception:
+            self.file.close()
+            raise
+        self.file.seek(0)
+        return self.file
+
+
+class TransplantTrain(object):
+    """Land several transplants to the same destination with a single push.
+
+    Each transplant is applied on top of the previous one, in a single working
+    copy, then they are all pushed together.
+    """
+
+    def __init__(self, transplants):
+        assert transplants, "empty train"
+        self.transplants = transplants
+        self.lead = transplants[0]
+        for tp in transplants:
+            assert tp.tree == self.lead.tree, "train spans trees"
+            assert tp.destination == self.lead.destination, "train spans destinations"
+
+    def __enter__(self):
+        self.lead.__enter__()
+        for tp in self.transplants[1:]:
+            tp.path = self.lead.path
+            tp.hg_repo = self.lead.hg_repo
+            tp.ssh_config = self.lead.ssh_config
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for tp in self.transplants[1:]:
+            if isinstance(tp, PatchTransplant):
+                tp.discard_downloads()
+        self.lead.__exit__(exc_type, exc_val, exc_tb)
+
+    def push(self, bookmark=None):
+        """Returns the landed revision of each transplant, in order."""
+        # Download the patches for the whole train while the repo is updated.
+        for tp in self.transplants:
+            if isinstance(tp, PatchTransplant):
+                tp.start_downloads()
+
+        target_cset = self.lead.update_repo()
+
+        revs = []
+        for tp in self.transplants:
+            try:
+                rev = tp.apply_changes(target_cset)
+            except Exception as e:
+                raise TransplantTrainError(tp, str(e))
+            revs.append(rev)
+            target_cset = rev[:12]
+
+        if bookmark:
+            self.lead.run_hg_cmds(
+                [
+                    ["bookmark", bookmark],
+                    ["push", "-B", bookmark, self.lead.destination],
+                ]
+            )
+        else:
+            self.lead.run_hg_cmds([["push", "-r", "tip", self.lead.destination]])
+
+        return revs
@@ -1,5 +1,7 @@
+import datetime
 import logging
 import os
+import threading
 
 import config
 import requests
@@ -9,18 +11,61 @@ import requests
 TREESTATUS_PROD_URL = "https://treestatus.mozilla-releng.net/trees/%s"
 TREESTATUS_TEST_URL = "http://treestatus/%s?format=json"
 
+# (connect, read) timeouts for treestatus requests, in seconds
+TREESTATUS_TIMEOUT = (3.05, 10)
+
+# how long to cache the status of an open tree
+OPEN_TTL = datetime.timedelta(seconds=30)
+
+# how long to cache the status of a closed tree, or a tree we failed to get
+# the status of; closed trees are not retried until this has passed
+CLOSED_TTL = datetime.timedelta(minutes=1)
+
+# how long to treat a tree as closed after a push to it was rejected because
+# it's closed, even if treestatus still reports it as open
+REJECTED_TTL = datetime.timedelta(minutes=5)
+
 logger = logging.getLogger("autoland")
 
+_session = requests.Session()
+_cache = {}
+_cache_lock = threading.Lock()
 
-def tree_is_open(tree):
-    treestatus_url = os.getenv(
+
+def _treestatus_url():
+    return os.getenv(
         "TREESTATUS_URL",
         TREESTATUS_TEST_URL if config.testing() else TREESTATUS_PROD_URL,
     )
 
+
+def _ttl(is_open):
+    if config.testing():
+        return datetime.timedelta(seconds=1)
+    return OPEN_TTL if is_open else CLOSED_TTL
+
+
+def _cache_status(tree, is_open, ttl=None):
+    if ttl is None or config.testing():
+        ttl = _ttl(is_open)
+    with _cache_lock:
+        _cache[tree] = (is_open, datetime.datetime.now() + ttl)
+    return is_open
+
+
+def _cached_status(tree):
+    """Returns the cached status of the tree, or None if unknown/expired."""
+    with _cache_lock:
+        is_open, expires = _cache.get(tree, (None, None))
+    if expires is None or expires <= datetime.datetime.now():
+        return None
+    return is_open
+
+
+def _fetch_tree(tree):
     r = None
     try:
-        r = requests.get(treestatus_url % tree)
+        r = _session.get(_treestatus_url() % tree, timeout=TREESTATUS_TIMEOUT)
 
         if r.status_code == 200:
             res = r.json()
@@ -45,3 +90,54 @@ def tree_is_open(tree):
         logger.error("Failed to determine treestatus for %s: %s" % (tree, e))
 
     return False
+
+
+def _fetch_all():
+    """Returns the status of all trees, or None on failure."""
+    try:
+        r = _session.get(_treestatus_url() % "", timeout=TREESTATUS_TIMEOUT)
+        r.raise_for_status()
+        res = r.json()
+        if "result" in res:
+            res = res["result"]
+        return dict((tree, status["status"] == "open") for tree, status in res.items())
+    except Exception as e:
+        logger.debug("Failed to fetch status of all trees: %s" % e)
+        return None
+
+
+def refresh(trees):
+    """Refreshes the cached status of the trees which have expired.
+
+    If more than one tree needs refreshing, the status of every tree is
+    fetched with a single request.
+    """
+    expired = set(tree for tree in trees if _cached_status(tree) is None)
+    if len(expired) < 2:
+        return
+
+    statuses = _fetch_all()
+    if statuses is None:
+        return
+    for tree in expired:
+        # We assume unrecognized trees are open
+        _cache_status(tree, statuses.get(tree, True))
+
+
+def tree_is_open(tree):
+    is_open = _cached_status(tree)
+    if is_open is None:
+        is_open = _cache_status(tree, _fetch_tree(tree))
+    return is_open
+
+
+def set_closed(tree):
+    """Records that the tree was found to be closed while pushing."""
+    _cache_status(tree, False, REJECTED_TTL)
+
+
+def next_check(tree):
+    """Returns when the status of the tree will next be checked."""
+    with _cache_lock:
+        is_open, expires = _cache.get(tree, (None, None))
+    return expires or datetime.datetime.now()
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
+import glob
 import json
+import os
 import sys
 import time
 
 import psycopg2
 
+# Databases created before migrations were tracked already include every
+# migration up to and including this one.
+UNTRACKED_MIGRATIONS = '0009'
+
 
 def db_conn(dsn):
     # Wait for the postgres server to startup.
@@ -20,6 +26,21 @@ def db_conn(dsn):
     raise Exception('failed to connect to postgres: %s' % last_error)
 
 
+def migrations(sql_file):
+    schema_dir = os.path.dirname(os.path.abspath(sql_file))
+    return sorted(glob.glob(os.path.join(schema_dir, '[0-9][0-9][0-9][0-9]-*.sql')))
+
+
+def table_exists(curs, db_name, table_name):
+    curs.execute(
+        "SELECT EXISTS ("
+        "   SELECT 1"
+        "     FROM information_schema.tables"
+        "    WHERE table_catalog='%s' AND table_name='%s'"
+        ")" % (db_name, table_name))
+    return curs.fetchone()[0]
+
+
 if len(sys.argv) != 3:
     print('syntax: create-schema.py <config.json file> <schema.sql file>')
     sys.exit(1)
@@ -36,13 +57,37 @@ with db_conn(config['database']) as conn:
     with conn.cursor() as curs:
         curs.execute("SELECT current_database()")
         db_name = curs.fetchone()[0]
-        curs.execute(
-            "SELECT EXISTS ("
-            "   SELECT 1"
-            "     FROM information_schema.tables"
-            "    WHERE table_catalog='%s' AND table_name='%s'"
-            ")" % (db_name, 'transplant'))
 
-        if not curs.fetchone()[0]:
+        if not table_exists(curs, db_name, 'transplant'):
             print('initialising schema from %s' % sql_file)
             curs.execute(open(sql_file).read())
+            applied = set(os.path.basename(m) for m in migrations(sql_file))
+        elif not table_exists(curs, db_name, 'schemamigration'):
+            applied = set(
+                os.path.basename(m) for m in migrations(sql_file)
+                if os.path.basename(m)[:4] <= UNTRACKED_MIGRATIONS)
+        else:
+            curs.execute("SELECT name FROM SchemaMigration")
+            applied = set(row[0] for row in curs.fetchall())
+
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS SchemaMigration ("
+            "   name varchar(255) primary key"
+            ")")
+        for name in applied:
+            curs.execute(
+                "INSERT INTO SchemaMigration (name) VALUES (%s) "
+                "ON CONFLICT DO NOTHING", (name,))
+
+        # Bring an existing database up to date with schema.sql.
+        for migration in migrations(sql_file):
+            name = os.path.basename(migration)
+            if name in applied:
+                continue
+            print('applying %s' % name)
+            with conn:
+                conn.autocommit = False
+                curs.execute(open(migration).read())
+                curs.execute(
+                    "INSERT INTO SchemaMigration (name) VALUES (%s)", (name,))
+            conn.autocommit = True
@@ -5,6 +5,7 @@ import base64
 import json
 import os
 import subprocess
+import sys
 import time
 
 import requests.adapters
@@ -45,27 +46,56 @@ def post_job(args):
         with open(args.patch_file) as f:
             data["patch"] = base64.b64encode(f.read())
 
+    headers = {"Content-Type": "application/json"}
+    if args.idempotency_key:
+        headers["Idempotency-Key"] = args.idempotency_key
+
     r = requests_session.post(
         AUTOLAND_URL,
         data=json.dumps(data, sort_keys=True),
-        headers={"Content-Type": "application/json"},
+        headers=headers,
         auth=(args.username, args.password),
     )
     print(r.status_code, r.text)
 
 
+def post_batch(args):
+    """Post a batch of jobs, read as a JSON list from stdin."""
+    batch = json.load(sys.stdin)
+    for data in batch:
+        if isinstance(data, dict):
+            data.setdefault("pingback_url", "http://localhost:9898/")
+            data.setdefault("ldap_username", "autolanduser@example.com")
+
+    r = requests_session.post(
+        AUTOLAND_URL + "/batch",
+        data=json.dumps(batch, sort_keys=True),
+        headers={"Content-Type": "application/json"},
+        auth=(args.username, args.password),
+    )
+    print(r.status_code)
+    try:
+        print(json.dumps(r.json(), indent=2, sort_keys=True, separators=(",", ": ")))
+    except ValueError:
+        print(r.text)
+
+
 def job_status(args):
     """Check job status.  If --poll is provided, block until job is complete."""
     url = "%s/status/%s" % (AUTOLAND_URL, args.request_id)
 
+    auth = (args.username, args.password)
+
     if not args.poll:
-        r = requests_session.get(url)
+        r = requests_session.get(url, auth=auth)
         print(r.status_code, r.text)
         return
 
     start_time = time.time()
     while time.time() - start_time < POLL_TIMEOUT:
-        r = requests_session.get(url)
+        # Long-poll; the API responds as soon as the job is serviced.
+        wait = POLL_TIMEOUT - (time.time() - start_time)
+        r = requests_session.get(url, params={"wait": wait}, auth=auth)
         res = r.json()
         if r.status_code != 200 or res["landed"] is not None:
             if args.raw:
@@ -79,7 +109,6 @@ def job_status(args):
                 # empty lines and trailing \n make writing tests harder, so remove those
                 print(res_json.replace("\\n", "\n").replace("\n\n", "\n").rstrip())
             return
-        time.sleep(0.1)
 
     print("timed out")
 
@@ -142,8 +171,17 @@ def main():
         cmd.add_argument("--password", default="autoland", help="autoland api password")
         cmd.add_argument("--patch-url", help="URL of patch")
         cmd.add_argument("--patch-file", help="Patch file to inline into request")
+        cmd.add_argument("--idempotency-key", help="Idempotency key for the request")
         cmd.set_defaults(func=post_job)
 
+        # post-batch
+        cmd = subparsers.add_parser(
+            "post-batch", help="Post a JSON list of jobs from stdin to autoland"
+        )
+        cmd.add_argument("--username", default="autoland", help="autoland api username")
+        cmd.add_argument("--password", default="autoland", help="autoland api password")
+        cmd.set_defaults(func=post_batch)
+
         # job-status
         cmd = subparsers.add_parser("job-status", help="Get an autoland job status")
         cmd.add_argument("request_id", help="ID of the job for which to get status")
@@ -154,6 +192,8 @@ def main():
             % POLL_TIMEOUT,
         )
         cmd.add_argument("--raw", action="store_true", help="Output unmodified JSON")
+        cmd.add_argument("--username", default="autoland", help="autoland api username")
+        cmd.add_argument("--password", default="autoland", help="autoland api password")
         cmd.set_defaults(func=job_status)
 
         # exec
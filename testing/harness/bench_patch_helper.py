@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Benchmarks PatchHelper against large synthetic patches, comparing it with
+# the three-pass parser it replaced (or another implementation of
+# PatchHelper given with --baseline).
+#
+#   bench_patch_helper.py --size 128 --runs 3
+
+import argparse
+import imp
+import io
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(ROOT, "..", "..", "autoland"))
+
+from patch_helper import PatchHelper  # noqa: E402
+
+HEADER = """# HG changeset patch
+# User Synthetic Patch <synthetic@example.com>
+# Date 1523427125 -28800
+#      Wed Apr 11 14:12:05 2018 +0800
+# Node ID 3379ea3cea34ecebdcb2cf7fb9f7845861ea8f07
+# Parent  46c36c18528fe2cc780d5206ed80ae8e37d3545d
+Bug 1 - Synthetic patch for benchmarking
+
+"""
+
+
+def write_patch(f, size):
+    """Writes a patch with a diff of roughly size bytes to the file."""
+    f.write(HEADER)
+    hunk = "".join("+line %d of a synthetic file\n" % i for i in range(1000))
+    written = 0
+    file_no = 0
+    while written < size:
+        diff = (
+            "diff --git a/file%d b/file%d\n"
+            "--- a/file%d\n"
+            "+++ b/file%d\n"
+            "@@ -0,0 +1,1000 @@\n" % ((file_no,) * 4)
+        ) + hunk
+        f.write(diff)
+        written += len(diff)
+        file_no += 1
+
+
+def run(patch_helper, f):
+    """Returns the time taken to parse the patch and write its parts."""
+    started = time.time()
+    patch = patch_helper(f)
+    patch.header("User")
+    patch.header("Date")
+    patch.write_commit_description(io.BytesIO())
+    # transplant.py writes the diff to a temporary file for `hg import`.
+    with tempfile.TemporaryFile() as diff:
+        patch.write_diff(diff)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--size", type=int, default=128, help="Size of the diff in megabytes"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs")
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(ROOT, "patch_helper_baseline.py"),
+        help="Path of the module with the PatchHelper to compare against",
+    )
+    args = parser.parse_args()
+
+    baseline = imp.load_source("patch_helper_baseline", args.baseline).PatchHelper
+    implementations = [("baseline", baseline), ("current", PatchHelper)]
+
+    with tempfile.TemporaryFile() as f:
+        write_patch(f, args.size * 1024 * 1024)
+        f.flush()
+        size = f.tell()
+        megabytes = size / 1024.0 / 1024.0
+
+        # Alternate between the implementations so both see the same cache.
+        timings = dict((name, []) for name, _ in implementations)
+        for _ in range(args.runs):
+            for name, patch_helper in implementations:
+                timings[name].append(run(patch_helper, f))
+
+    print("patch size: %.1fMB" % megabytes)
+    for name, _ in implementations:
+        for i, elapsed in enumerate(timings[name]):
+            print(
+                "%s run %d: %.3fs (%.1fMB/s)"
+                % (name, i + 1, elapsed, megabytes / elapsed)
+            )
+    best = dict((name, min(runs)) for name, runs in timings.items())
+    print("best: baseline %.3fs, current %.3fs" % (best["baseline"], best["current"]))
+    print("speedup: %.2fx" % (best["baseline"] / best["current"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'autoland')))
+
+from pingback import (
+    PINGBACK_BACKOFF_BASE,
+    PINGBACK_BACKOFF_MAX,
+    PINGBACK_FAILURE_THRESHOLD,
+    PINGBACK_RETRY_DELAY,
+    CircuitBreaker,
+)
+
+NOW = datetime.datetime(2018, 4, 11, 14, 12, 5)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def open_breaker(self, breaker):
+        for i in range(PINGBACK_FAILURE_THRESHOLD - 1):
+            breaker.failed(NOW)
+        return breaker.failed(NOW)
+
+    def test_closed(self):
+        breaker = CircuitBreaker(2)
+        self.assertEqual(breaker.state(NOW), CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.available(NOW))
+
+        breaker.in_flight = 2
+        self.assertFalse(breaker.available(NOW))
+
+    def test_failures_below_threshold(self):
+        breaker = CircuitBreaker(2)
+        for i in range(PINGBACK_FAILURE_THRESHOLD - 1):
+            self.assertEqual(breaker.failed(NOW), NOW + PINGBACK_RETRY_DELAY)
+            self.assertEqual(breaker.state(NOW), CircuitBreaker.CLOSED)
+
+    def test_opens(self):
+        breaker = CircuitBreaker(2)
+        retry_at = self.open_breaker(breaker)
+        self.assertEqual(retry_at, NOW + PINGBACK_BACKOFF_BASE)
+        self.assertEqual(breaker.state(NOW), CircuitBreaker.OPEN)
+        self.assertFalse(breaker.available(NOW))
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(2)
+        retry_at = self.open_breaker(breaker)
+        self.assertEqual(breaker.state(retry_at), CircuitBreaker.HALF_OPEN)
+
+        # Only a single trial is posted.
+        self.assertTrue(breaker.available(retry_at))
+        breaker.in_flight = 1
+        self.assertFalse(breaker.available(retry_at))
+
+    def test_trial_succeeds(self):
+        breaker = CircuitBreaker(2)
+        retry_at = self.open_breaker(breaker)
+        breaker.succeeded()
+        self.assertEqual(breaker.state(retry_at), CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failed(retry_at), retry_at + PINGBACK_RETRY_DELAY)
+
+    def test_trial_fails(self):
+        breaker = CircuitBreaker(2)
+        retry_at = self.open_breaker(breaker)
+
+        # The breaker opens again for twice as long, up to the maximum.
+        retry_at = breaker.failed(retry_at)
+        self.assertEqual(breaker.state(retry_at - datetime.timedelta(seconds=1)),
+                         CircuitBreaker.OPEN)
+        self.assertEqual(retry_at,
+                         NOW + PINGBACK_BACKOFF_BASE + 2 * PINGBACK_BACKOFF_BASE)
+
+        for i in range(20):
+            last_retry_at = retry_at
+            retry_at = breaker.failed(retry_at)
+        self.assertEqual(retry_at - last_retry_at, PINGBACK_BACKOFF_MAX)
@@ -0,0 +1,239 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'autoland')))
+
+import config
+
+config_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+json.dump({}, config_file)
+config_file.close()
+config.CONFIG_PATH = config_file.name
+config.CONFIG = None
+
+import autoland
+from autoland import LandingRequest, landing_trains
+from transplant import TransplantTrainError
+
+
+def landing_request(transplant_id, rev, requester='user@example.com',
+                    destination='upstream', patch_urls=True):
+    request = {
+        'ldap_username': requester,
+        'tree': 'mozilla-central',
+        'rev': rev,
+    }
+    if patch_urls:
+        request['patch_urls'] = ['s3://bucket/%s.patch' % rev]
+    return LandingRequest(
+        (transplant_id, destination, request, 0, False), None)
+
+
+class FakeCursor(object):
+    # transplant ids whose results fail to be recorded
+    broken = set()
+
+    def __init__(self):
+        self.finished = {}
+        self.retried = []
+        self.released = []
+
+    def execute(self, query, params=None):
+        if query.strip().startswith('update Transplant set last_updated'):
+            self.retried.append(params[-1])
+        if query.strip().startswith('update Transplant set claimed_by=NULL'):
+            self.released.extend(params[0])
+        if query.strip().startswith('update Transplant set landed'):
+            landed, result, attempts, transplant_id = params
+            if transplant_id in self.broken:
+                raise Exception('database error')
+            self.finished[transplant_id] = (landed, result)
+
+    def executemany(self, query, params):
+        pass
+
+
+class FakeDbconn(object):
+    closed = False
+
+    def __init__(self):
+        self.fake_cursor = FakeCursor()
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeTransplant(object):
+    # revs which fail to apply, are rejected when pushed, and lose a push
+    # race
+    bad_patches = set()
+    rejected = set()
+    slow = set()
+    races = set()
+
+    def __init__(self, tree, destination, rev, patch_urls, requester=None):
+        self.tree = tree
+        self.destination = destination
+        self.rev = rev
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def push(self):
+        return FakeTrain([self]).push(None)[0]
+
+
+class FakeTrain(object):
+    def __init__(self, transplants):
+        self.transplants = transplants
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def push(self, bookmark):
+        for tp in self.transplants:
+            if tp.rev in FakeTransplant.bad_patches:
+                raise TransplantTrainError(tp, 'hunk FAILED -- saving rejects')
+        for tp in self.transplants:
+            if tp.rev in FakeTransplant.slow:
+                time.sleep(2)
+            if tp.rev in FakeTransplant.rejected:
+                raise Exception('abort: pretxnchangegroup.hook failed')
+            if tp.rev in FakeTransplant.races:
+                raise Exception('abort: push creates new remote head')
+        return ['landed-%s' % tp.rev for tp in self.transplants]
+
+
+class TestLandingTrains(unittest.TestCase):
+    def test_consecutive_requests(self):
+        reqs = [landing_request(i, 'rev%s' % i) for i in range(3)]
+        self.assertEqual(landing_trains(reqs), [reqs])
+
+    def test_train_keys(self):
+        a = landing_request(1, 'a')
+        b = landing_request(2, 'b', requester='other@example.com')
+        c = landing_request(3, 'c', requester='other@example.com')
+        d = landing_request(4, 'd', patch_urls=False)
+        e = landing_request(5, 'e', requester='other@example.com')
+        self.assertEqual(landing_trains([a, b, c, d, e]),
+                         [[a], [b, c], [d], [e]])
+
+    def test_max_train_length(self):
+        reqs = [landing_request(i, 'rev%s' % i)
+                for i in range(autoland.MAX_TRAIN_LENGTH + 1)]
+        self.assertEqual(landing_trains(reqs),
+                         [reqs[:-1], reqs[-1:]])
+
+
+class TestSplitTrains(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(
+            (name, getattr(autoland, name)) for name in (
+                'claim_pending_transplants', 'heartbeat_transplants',
+                'PatchTransplant', 'TransplantTrain', 'TRANSPLANT_HEARTBEAT'))
+        FakeTransplant.bad_patches = set()
+        FakeTransplant.rejected = set()
+        FakeTransplant.slow = set()
+        FakeTransplant.races = set()
+        FakeCursor.broken = set()
+        self.heartbeats = []
+        autoland.heartbeat_transplants = (
+            lambda dbconn: self.heartbeats.append(time.time()))
+        autoland.PatchTransplant = FakeTransplant
+        autoland.TransplantTrain = FakeTrain
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(autoland, name, value)
+
+    def land(self, revs, destinations=None, requesters=None):
+        destinations = destinations or ['upstream'] * len(revs)
+        requesters = requesters or ['user@example.com'] * len(revs)
+        rows = [
+            (i, destinations[i], {'ldap_username': requesters[i],
+                                  'tree': 'mozilla-central',
+                                  'rev': rev,
+                                  'patch_urls': ['s3://bucket/%s.patch' % rev]},
+             0, False)
+            for i, rev in enumerate(revs)
+        ]
+        autoland.claim_pending_transplants = lambda dbconn, now, limit: rows
+        self.dbconn = FakeDbconn()
+        autoland.handle_pending_transplants(self.dbconn)
+        return [self.dbconn.fake_cursor.finished.get(i)
+                for i in range(len(revs))]
+
+    def test_train_lands(self):
+        self.assertEqual(self.land(['a', 'b']),
+                         [(True, 'landed-a'), (True, 'landed-b')])
+
+    def test_split_bad_patch(self):
+        FakeTransplant.bad_patches = set(['a'])
+        results = self.land(['a', 'b', 'c'])
+        self.assertFalse(results[0][0])
+        self.assertEqual(results[1:],
+                         [(True, 'landed-b'), (True, 'landed-c')])
+
+    def test_rejected_push(self):
+        FakeTransplant.rejected = set(['b'])
+        results = self.land(['a', 'b', 'c'])
+        self.assertEqual(results[0], (True, 'landed-a'))
+        self.assertEqual(results[1],
+                         (False, 'abort: pretxnchangegroup.hook failed'))
+        self.assertEqual(results[2], (True, 'landed-c'))
+
+    def test_worker_failure(self):
+        # A worker failing mustn't stop the claims on the transplants other
+        # workers are still landing from being kept alive.
+        autoland.TRANSPLANT_HEARTBEAT = datetime.timedelta(0)
+        FakeCursor.broken = set([0])
+        FakeTransplant.slow = set(['b'])
+        self.assertRaises(Exception, self.land, ['a', 'b'],
+                          destinations=['upstream', 'other'])
+        self.assertTrue(self.heartbeats)
+
+    def test_push_race_keeps_order(self):
+        # Requests behind one which lost a push race wait for it to land.
+        FakeTransplant.races = set(['b'])
+        results = self.land(
+            ['a', 'b', 'c', 'd', 'e'],
+            destinations=['upstream'] * 4 + ['other'],
+            requesters=['1@example.com', '2@example.com', '3@example.com',
+                        '4@example.com', '5@example.com'])
+        self.assertEqual(results, [(True, 'landed-a'), None, None, None,
+                                   (True, 'landed-e')])
+        self.assertEqual(self.dbconn.fake_cursor.retried, [1])
+        self.assertEqual(self.dbconn.fake_cursor.released, [2, 3])
+
+    def test_push_race_one_at_a_time(self):
+        # A request which loses a push race while its train is landed one
+        # request at a time holds up the rest of the train.
+        FakeTransplant.rejected = set(['a'])
+        FakeTransplant.races = set(['b'])
+        results = self.land(['a', 'b', 'c'])
+        self.assertEqual(results[0],
+                         (False, 'abort: pretxnchangegroup.hook failed'))
+        self.assertEqual(results[1:], [None, None])
+        self.assertEqual(self.dbconn.fake_cursor.released, [2])
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'autoland')))
+
+import config
+from patch_cache import PatchCache
+
+URL = 's3://bucket/a.patch'
+OTHER_URL = 's3://bucket/b.patch'
+
+
+class TestPatchCache(unittest.TestCase):
+    def setUp(self):
+        self.saved = (config.CONFIG_PATH, config.CONFIG)
+        self.path = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.path, 'config.json')
+        self.cache_dir = os.path.join(self.path, 'patch-cache')
+        self.configure(10)
+        self.cache = PatchCache()
+
+    def tearDown(self):
+        config.CONFIG_PATH, config.CONFIG = self.saved
+        shutil.rmtree(self.path)
+
+    def configure(self, max_size):
+        with open(self.config_path, 'w') as f:
+            json.dump({'patch_cache_dir': self.cache_dir,
+                       'patch_cache_max_size': max_size}, f)
+        config.CONFIG_PATH = self.config_path
+        config.CONFIG = None
+
+    def store(self, url, etag, patch, mtime=None):
+        f = self.cache.store(url, etag, io.BytesIO(patch))
+        self.assertEqual(f.read(), patch)
+        if mtime is not None:
+            os.utime(self.cache._entry_file(url, etag), (mtime, mtime))
+
+    def cached(self, url, etag):
+        f = self.cache.open(url, etag)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_store(self):
+        self.assertEqual(self.cache.etag(URL), None)
+        self.store(URL, '"1"', b'patch')
+        self.assertEqual(self.cache.etag(URL), '"1"')
+        self.assertEqual(self.cached(URL, '"1"'), b'patch')
+        self.assertEqual(self.cached(URL, '"2"'), None)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+        # Nothing is left behind besides the entry and its index.
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_no_etag(self):
+        self.store(URL, None, b'patch')
+        self.assertEqual(self.cache.etag(URL), None)
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 1})
+
+    def test_disabled(self):
+        self.configure(0)
+        self.store(URL, '"1"', b'patch')
+        self.assertEqual(self.cache.etag(URL), None)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_evict_least_recently_used(self):
+        self.store(URL, '"1"', b'aaaaaa', mtime=1)
+        self.store(OTHER_URL, '"1"', b'bbbbbb', mtime=2)
+        self.assertEqual(self.cache.etag(URL), None)
+        self.assertEqual(self.cached(URL, '"1"'), None)
+        self.assertEqual(self.cache.etag(OTHER_URL), '"1"')
+        self.assertEqual(self.cached(OTHER_URL, '"1"'), b'bbbbbb')
+        self.assertFalse(os.path.exists(self.cache._index_file(URL)))
+
+    def test_evict_old_version(self):
+        # Evicting the copy of an earlier ETag of a url mustn't forget the
+        # url's current ETag.
+        self.store(URL, '"1"', b'aaaaaa', mtime=1)
+        self.store(URL, '"2"', b'bbbbbb', mtime=2)
+        self.assertEqual(self.cached(URL, '"1"'), None)
+        self.assertEqual(self.cache.etag(URL), '"2"')
+        self.assertEqual(self.cached(URL, '"2"'), b'bbbbbb')
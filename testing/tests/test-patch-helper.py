@@ -5,6 +5,7 @@
 import io
 import os
 import sys
+import tempfile
 import unittest
 
 sys.path.append(os.path.abspath(
@@ -212,3 +213,48 @@ diff --git a/autoland/autoland/transplant.py b/autoland/autoland/transplant.py
         buf = io.BytesIO('')
         patch.write_diff(buf)
         self.assertEqual(buf.getvalue(), diff)
+
+    def test_write_from_file(self):
+        header = """
+# HG changeset patch
+# User byron jones <glob@mozilla.com>
+# Date 1523427125 -28800
+#      Wed Apr 11 14:12:05 2018 +0800
+# Node ID 3379ea3cea34ecebdcb2cf7fb9f7845861ea8f07
+# Parent  46c36c18528fe2cc780d5206ed80ae8e37d3545d
+""".strip()
+        commit_desc = """
+WIP transplant and diff-start-line
+""".strip()
+        # Large enough that iterating over the file would read ahead past
+        # the start of the diff.
+        diff = 'diff --git a/file b/file\n' + '+line\n' * 10000
+
+        # Patches are downloaded to temporary files spooled to disk, which
+        # don't allow mixing iteration with read().
+        with tempfile.TemporaryFile() as f:
+            f.write('%s\n%s\n\n%s' % (header, commit_desc, diff))
+            patch = PatchHelper(f)
+
+            buf = io.BytesIO('')
+            patch.write_commit_description(buf)
+            self.assertEqual(buf.getvalue(), commit_desc)
+
+            buf = io.BytesIO('')
+            patch.write_diff(buf)
+            self.assertEqual(buf.getvalue(), diff)
+
+    def test_header_only(self):
+        patch = PatchHelper(io.BytesIO("""
+# HG changeset patch
+# User byron jones <glob@mozilla.com>
+# Date 1523427125 -28800
+""".strip() + '\n'))
+
+        self.assertEqual(patch.header('User'),
+                         'byron jones <glob@mozilla.com>')
+        self.assertEqual(patch.commit_description(), '')
+
+        buf = io.BytesIO('')
+        patch.write_diff(buf)
+        self.assertEqual(buf.getvalue(), '')
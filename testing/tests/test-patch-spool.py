@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..', 'autoland')))
+
+import config
+import transplant
+from transplant import PatchSpool, PatchTransplant
+
+PATCH_URL = 's3://bucket/a.patch'
+
+
+class FakeBody(io.BytesIO):
+    closed_by_caller = False
+
+    def close(self):
+        self.closed_by_caller = True
+        super(FakeBody, self).close()
+
+
+class FakeS3(object):
+    def __init__(self, body, content_length):
+        self.body = FakeBody(body)
+        self.content_length = content_length
+
+    def get(self, bucket, bucket_config):
+        return self
+
+    def get_object(self, **kwargs):
+        return {'Body': self.body, 'ContentLength': self.content_length}
+
+
+class TestPatchSpool(unittest.TestCase):
+    def setUp(self):
+        self.saved = (config.CONFIG_PATH, config.CONFIG, transplant.S3_CLIENTS)
+        f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        json.dump({'patch_max_size': 10,
+                   'patch_cache_max_size': 0,
+                   'patch_url_buckets': {
+                       'bucket': {'aws_access_key_id': 'id',
+                                  'aws_secret_access_key': 'secret'}}}, f)
+        f.close()
+        self.config_path = f.name
+        config.CONFIG_PATH = self.config_path
+        config.CONFIG = None
+
+    def tearDown(self):
+        config.CONFIG_PATH, config.CONFIG, transplant.S3_CLIENTS = self.saved
+        os.unlink(self.config_path)
+
+    def test_check_size(self):
+        spool = PatchSpool(PATCH_URL)
+        spool.check_size(10)
+        self.assertRaisesRegexp(Exception, 'patch is larger than 10 bytes',
+                                spool.check_size, 11)
+
+    def test_download(self):
+        spool = PatchSpool(PATCH_URL, lstrip=True)
+        f = spool.download(['\n', '  patch', ' file'])
+        self.assertEqual(f.read(), 'patch file')
+
+    def test_write_too_large(self):
+        spool = PatchSpool(PATCH_URL)
+        self.assertRaisesRegexp(Exception, 'patch is larger than 10 bytes',
+                                spool.download, ['patch', ' file', '!'])
+        self.assertTrue(spool.file.closed)
+
+    def test_s3_content_length_too_large(self):
+        # The response body is closed when the download is refused.
+        s3 = transplant.S3_CLIENTS = FakeS3('patch file!', 11)
+        self.assertRaisesRegexp(Exception, 'patch is larger than 10 bytes',
+                                PatchTransplant._download_from_s3, PATCH_URL)
+        self.assertTrue(s3.body.closed_by_caller)
+
+    def test_s3_body_too_large(self):
+        s3 = transplant.S3_CLIENTS = FakeS3('patch file!', 10)
+        self.assertRaisesRegexp(Exception, 'patch is larger than 10 bytes',
+                                PatchTransplant._download_from_s3, PATCH_URL)
+        self.assertTrue(s3.body.closed_by_caller)
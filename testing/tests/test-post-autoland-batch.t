@@ -0,0 +1,81 @@
+  $ . $TESTDIR/testing/harness/helpers.sh
+  $ setup_test_env
+  Restarting Test Environment
+
+Stop the autoland service so submitted requests stay in progress.
+
+  $ docker stop autoland_test.daemon
+  autoland_test.daemon
+  $ autolandctl post-job test-repo p1 land-repo --trysyntax "stuff"
+  (200, u'{"request_id":1}\n')
+
+Posting a batch with bad credentials should fail
+
+  $ echo '[]' | autolandctl post-batch --username blah --password blah
+  401
+  Login required
+
+The batch must be a list
+
+  $ echo '{}' | autolandctl post-batch
+  400
+  {
+    "error": "Bad request: expected a list"
+  }
+
+Post a batch mixing valid requests, invalid requests, a duplicate within the
+batch, a duplicate of a request already in progress and requests with fields
+of the wrong type.  Results are returned in the order the requests were
+submitted.  The rejected duplicate of p1 uses up request id 3.
+
+  $ autolandctl post-batch <<EOF
+  > [
+  >   {"tree": "test-repo", "rev": "p2", "destination": "land-repo", "trysyntax": "stuff"},
+  >   {"tree": "test-repo", "destination": "land-repo", "trysyntax": "stuff"},
+  >   "junk",
+  >   {"tree": "test-repo", "rev": "p2", "destination": "land-repo", "trysyntax": "stuff"},
+  >   {"tree": "test-repo", "rev": "p1", "destination": "land-repo", "trysyntax": "stuff"},
+  >   {"tree": "test-repo", "rev": "p3", "destination": "land-repo", "trysyntax": "stuff",
+  >    "pingback_url": "http://example.org:9898"},
+  >   {"tree": "test-repo", "rev": ["p5"], "destination": "land-repo", "trysyntax": "stuff"},
+  >   {"tree": "test-repo", "rev": "p6", "destination": 1, "trysyntax": "stuff"},
+  >   {"tree": "test-repo", "rev": "p4", "destination": "land-repo", "trysyntax": "stuff"}
+  > ]
+  > EOF
+  200
+  {
+    "results": [
+      {
+        "request_id": 2
+      },
+      {
+        "error": "Bad request: missing required field: rev"
+      },
+      {
+        "error": "Bad request: missing json"
+      },
+      {
+        "error": "Bad Request: a request to land revision p2 to land-repo is already in progress"
+      },
+      {
+        "error": "Bad Request: a request to land revision p1 to land-repo is already in progress"
+      },
+      {
+        "error": "Bad request: bad pingback_url"
+      },
+      {
+        "error": "Bad request: rev must be a string"
+      },
+      {
+        "error": "Bad request: destination must be a string"
+      },
+      {
+        "request_id": 4
+      }
+    ]
+  }
+
+The accepted requests are in progress
+
+  $ autolandctl post-job test-repo p4 land-repo --trysyntax "stuff"
+  (400, u'{"error":"Bad Request: a request to land revision p4 to land-repo is already in progress"}\n')
@@ -393,3 +393,13 @@ guarentee the first request is still in the queue when the second is submitted.
   (200, u'{"request_id":18}\n')
   $ autolandctl post-job test-repo p18 land-repo --trysyntax "stuff"
   (400, u'{"error":"Bad Request: a request to land revision p18 to land-repo is already in progress"}\n')
+
+Resubmitting with the same idempotency key returns the original request.  The
+rejected duplicate above used up request id 19.
+
+  $ autolandctl post-job test-repo p19 land-repo --trysyntax "stuff" --idempotency-key p19-key
+  (200, u'{"request_id":20}\n')
+  $ autolandctl post-job test-repo p19 land-repo --trysyntax "stuff" --idempotency-key p19-key
+  (200, u'{"request_id":20}\n')
+  $ autolandctl post-job test-repo p19 land-repo --trysyntax "stuff" --idempotency-key other-key
+  (400, u'{"error":"Bad Request: a request to land revision p19 to land-repo is already in progress"}\n')
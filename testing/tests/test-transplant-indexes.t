@@ -0,0 +1,45 @@
+  $ . $TESTDIR/testing/harness/helpers.sh
+  $ setup_test_env
+  Restarting Test Environment
+
+Seed the Transplant table with a million landed requests and a few pending
+ones; the pending requests aren't due yet so the daemon leaves them alone.
+
+  $ autolandctl exec --container=db psql -q -U autoland autoland -c "
+  > INSERT INTO Transplant (destination, request, landed, result)
+  > SELECT 'land-repo',
+  >        json_build_object('rev', 'r' || i, 'destination', 'land-repo')::jsonb,
+  >        true, 'landed'
+  >   FROM generate_series(1, 1000000) AS i;
+  > INSERT INTO Transplant (destination, request, next_attempt_at)
+  > SELECT 'land-repo',
+  >        json_build_object('rev', 'p' || i, 'destination', 'land-repo')::jsonb,
+  >        now() + interval '1 day'
+  >   FROM generate_series(1, 5) AS i;
+  > ANALYZE Transplant;"
+
+The daemon's claim statement, including its per-destination NOT EXISTS check,
+uses the partial pending index
+
+  $ autolandctl exec /home/autoland/venv/bin/python - <<EOF | grep -o 'transplant_pending_idx\|Seq Scan' | sort -u
+  > import datetime, sys
+  > sys.path.insert(0, '/home/autoland/src')
+  > import autoland, config
+  > cursor = autoland.get_dbconn(config.get('database')).cursor()
+  > cursor.execute('EXPLAIN ' + autoland.CLAIM_PENDING_QUERY, {
+  >     'worker': 'test', 'lease': autoland.TRANSPLANT_CLAIM_LEASE,
+  >     'time': datetime.datetime.now(), 'limit': autoland.TRANSPLANT_BATCH_SIZE})
+  > for row in cursor.fetchall():
+  >     print(row[0])
+  > EOF
+  transplant_pending_idx
+
+The API's in-flight duplicate check doesn't scan the table
+
+  $ autolandctl exec --container=db psql -q -U autoland autoland -t -c "
+  > EXPLAIN SELECT created
+  >           FROM Transplant
+  >          WHERE landed IS NULL
+  >                AND request->>'rev' = 'p1'
+  >                AND destination = 'land-repo'" | grep -q 'Seq Scan' && echo seq scan || echo indexed
+  indexed